@@ -0,0 +1,260 @@
+# vim: fileencoding=utf-8
+
+# Copyright (c) 2013 Mikhail Golubev
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Benchmarks of pot operations on synthetic repositories.
+
+Every benchmark runs in its own temporary directory with generated pot repository and
+home directory. Results are written as JSON, so runs on different commits can be compared:
+
+    python bench.py --scale 100 --scale 10000 --output new.json --compare old.json
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import pot
+from pot import cd, Config, DotFile
+
+# share of dotfiles installed with every action, the rest are symlinked
+COPY_SHARE = 0.1
+INCLUDE_SHARE = 0.1
+# number of rc files used as targets of 'include' action
+RC_FILES = 5
+
+
+def write_file(path, size):
+    with open(path, 'w') as fd:
+        line = '# generated line of configuration file\n'
+        fd.write(line * (size // len(line) + 1))
+
+
+def make_tree(path, depth, width, file_size):
+    """Create directory tree similar to vim plugins directory."""
+    os.mkdir(path)
+    for i in range(width):
+        write_file(os.path.join(path, 'file{}.vim'.format(i)), file_size)
+        if depth > 1:
+            make_tree(os.path.join(path, 'dir{}'.format(i)), depth - 1, width, file_size)
+
+
+def generate_repo(root, count, tree_depth=3, tree_width=4, file_size=1024, rc_size=1 << 20):
+    """Generate pot repository with count dotfiles in root/pot and empty home directory in root/home.
+
+    Copied dotfiles are directory trees of given depth and width, included dotfiles are
+    spread over a few large rc files.
+    """
+    repo = os.path.join(root, 'pot')
+    home = os.path.join(root, 'home')
+    dotfiles_dir = os.path.join(repo, 'dotfiles')
+    os.makedirs(dotfiles_dir)
+    os.makedirs(home)
+    copies = int(count * COPY_SHARE)
+    inclusions = int(count * INCLUDE_SHARE)
+    dotfiles = []
+    for i in range(count):
+        name = '.dotfile{}'.format(i)
+        src = os.path.join(dotfiles_dir, name)
+        if i < copies:
+            make_tree(src, tree_depth, tree_width, file_size)
+            dotfiles.append(DotFile(name, action='copy'))
+        elif i < copies + inclusions:
+            write_file(src, 64)
+            dotfiles.append(DotFile(name, target='~/.rc{}'.format(i % RC_FILES), action='include'))
+        else:
+            write_file(src, file_size)
+            dotfiles.append(DotFile(name))
+    for i in range(RC_FILES):
+        write_file(os.path.join(home, '.rc{}'.format(i)), rc_size)
+    with open(os.path.join(repo, 'config.yaml'), 'w') as fd:
+        Config(dotfiles).to_yaml(stream=fd)
+    return repo, home
+
+
+@contextmanager
+def home_dir(path):
+    old_home = os.environ.get('HOME')
+    os.environ['HOME'] = path
+    try:
+        yield
+    finally:
+        if old_home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = old_home
+
+
+def clean_home(repo, home, rc_size):
+    shutil.rmtree(home)
+    os.mkdir(home)
+    for i in range(RC_FILES):
+        write_file(os.path.join(home, '.rc{}'.format(i)), rc_size)
+    if os.path.exists(os.path.join(repo, pot.MANIFEST_NAME)):
+        os.remove(os.path.join(repo, pot.MANIFEST_NAME))
+
+
+def bench_config_cold(repo, home, rc_size):
+    cache = os.path.join(repo, pot.CONFIG_CACHE_NAME)
+    if os.path.exists(cache):
+        os.remove(cache)
+    start = time.perf_counter()
+    Config.load(os.path.join(repo, 'config.yaml'))
+    return time.perf_counter() - start
+
+
+def bench_config_warm(repo, home, rc_size):
+    Config.load(os.path.join(repo, 'config.yaml'))
+    start = time.perf_counter()
+    Config.load(os.path.join(repo, 'config.yaml'))
+    return time.perf_counter() - start
+
+
+def bench_init(repo, home, rc_size):
+    os.remove(os.path.join(repo, 'config.yaml'))
+    start = time.perf_counter()
+    pot.init(repo)
+    return time.perf_counter() - start
+
+
+def bench_install_cold(repo, home, rc_size, jobs=1):
+    clean_home(repo, home, rc_size)
+    with home_dir(home), cd(repo):
+        start = time.perf_counter()
+        pot.install(jobs=jobs)
+        return time.perf_counter() - start
+
+
+def bench_install_parallel(repo, home, rc_size):
+    return bench_install_cold(repo, home, rc_size, jobs=8)
+
+
+def bench_install_warm(repo, home, rc_size):
+    with home_dir(home), cd(repo):
+        pot.install()
+        start = time.perf_counter()
+        pot.install()
+        return time.perf_counter() - start
+
+
+def bench_grab(repo, home, rc_size):
+    names = ['.grabbed{}'.format(i) for i in range(max(len(os.listdir(os.path.join(repo, 'dotfiles'))) // 10, 1))]
+    for name in names:
+        write_file(os.path.join(home, name), 1024)
+    with home_dir(home):
+        os.environ['POT_HOME'] = repo
+        try:
+            start = time.perf_counter()
+            pot.grab([os.path.join(home, '.grabbed*')])
+            return time.perf_counter() - start
+        finally:
+            del os.environ['POT_HOME']
+
+
+BENCHMARKS = [
+    ('config_cold', bench_config_cold),
+    ('config_warm', bench_config_warm),
+    ('init', bench_init),
+    ('install_cold', bench_install_cold),
+    ('install_parallel', bench_install_parallel),
+    ('install_warm', bench_install_warm),
+    ('grab', bench_grab),
+]
+
+
+def run(scales, names, repeat, tree_depth, rc_size):
+    results = []
+    for scale in scales:
+        for name, func in BENCHMARKS:
+            if names and name not in names:
+                continue
+            runs = []
+            for _ in range(repeat):
+                temp_dir = tempfile.mkdtemp(prefix='pot-bench')
+                try:
+                    repo, home = generate_repo(temp_dir, scale, tree_depth=tree_depth, rc_size=rc_size)
+                    runs.append(func(repo, home, rc_size))
+                finally:
+                    shutil.rmtree(temp_dir)
+            result = {'benchmark': name, 'scale': scale, 'seconds': min(runs), 'runs': runs}
+            print('{:<18} {:>8} {:>10.4f}s'.format(name, scale, result['seconds']))
+            results.append(result)
+    return results
+
+
+def compare(results, baseline):
+    """Print ratio of current timings to the baseline ones."""
+    old = {(r['benchmark'], r['scale']): r['seconds'] for r in baseline['results']}
+    for result in results:
+        key = (result['benchmark'], result['scale'])
+        if key in old and old[key] > 0:
+            print('{:<18} {:>8} {:>8.2f}x'.format(key[0], key[1], result['seconds'] / old[key]))
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=int, action='append', metavar='N',
+                        help='number of generated dotfiles, can be repeated (default: 100)')
+    parser.add_argument('--benchmark', action='append', choices=[name for name, _ in BENCHMARKS],
+                        help='run only this benchmark, can be repeated')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the best one is reported')
+    parser.add_argument('--tree-depth', type=int, default=3, help='depth of copied directory trees')
+    parser.add_argument('--rc-size', type=int, default=1 << 20, help='size of rc files in bytes')
+    parser.add_argument('--output', metavar='FILE', help='write results as JSON to FILE')
+    parser.add_argument('--compare', metavar='FILE', help='compare results with previously saved ones')
+    args = parser.parse_args()
+
+    # pot reports every action, it's not what is measured
+    pot.logger.disabled = True
+    results = run(args.scale or [100], args.benchmark, args.repeat, args.tree_depth, args.rc_size)
+    report = {
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(report, fd, indent=2)
+    if args.compare:
+        with open(args.compare) as fd:
+            compare(results, json.load(fd))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
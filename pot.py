@@ -25,22 +25,120 @@ Pot is simple command-line utility that helps you to manage your precious dotfil
 """
 
 from __future__ import print_function
-import argparse
-import shutil
-import glob
+import errno
+import importlib
+import io
+import stat
 import logging
-import subprocess
+import time
 import sys
-from contextlib import contextmanager
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 
-import yaml
 import os
-import re
+
+
+class LazyModule(object):
+    """Module imported on the first access to its attributes.
+
+    Importing of YAML parser and other heavy modules is postponed until they are actually
+    needed, so that 'pot --help' and shell completion start fast.
+    """
+
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name)
+        # following accesses go directly to the module
+        globals()[self.__name] = module
+        return getattr(module, attr)
+
+
+argparse = LazyModule('argparse')
+asyncio = LazyModule('asyncio')
+fcntl = LazyModule('fcntl')
+glob = LazyModule('glob')
+hashlib = LazyModule('hashlib')
+json = LazyModule('json')
+mmap = LazyModule('mmap')
+pwd = LazyModule('pwd')
+re = LazyModule('re')
+signal = LazyModule('signal')
+select = LazyModule('select')
+shutil = LazyModule('shutil')
+struct = LazyModule('struct')
+subprocess = LazyModule('subprocess')
+tarfile = LazyModule('tarfile')
+tempfile = LazyModule('tempfile')
+yaml = LazyModule('yaml')
 
 VERBOSE_MESSAGE_FORMAT = '[%(levelname)s]:%(funcName)s:%(lineno)s %(message)s'
 DEFAULT_POT_HOME = '~/.pot'
+# names of configured dotfiles used by shell completion, stored next to config.yaml
+NAMES_INDEX_NAME = '.names'
 # file inclusion format in Bash and other shell-like command interpreters
 DEFAULT_INCLUSION_FORMAT = '. {src}'
+# state of installed dotfiles, stored in the root of pot repository
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+# manifests of installations into explicitly given home directories, stored in the repository
+MANIFESTS_DIR = 'manifests'
+# parsed configuration cached between runs, stored next to config.yaml
+CONFIG_CACHE_NAME = '.config.cache'
+CONFIG_CACHE_VERSION = 7
+# digests of files cached between runs, stored in the root of pot repository
+HASH_CACHE_NAME = '.hashes.json'
+HASH_CACHE_VERSION = 1
+# files of this size and larger are hashed through memory map
+MMAP_MIN_SIZE = 1 << 20
+HASH_CHUNK_SIZE = 8 << 20
+# files modified within this time before they were read may change again keeping the same mtime
+# on coarse-grained file systems, their stat can't be trusted to tell content is unchanged
+MTIME_GRANULARITY_NS = 2 * 10 ** 9
+# content-addressed store of large files of copied and rendered dotfiles, stored in the root of pot repository
+STORE_DIR = 'objects'
+STORE_INDEX_NAME = 'index.json'
+# smaller files aren't worth deduplication
+STORE_MIN_SIZE = 1 << 16
+# entries of dotfiles directory which are never dotfiles themselves
+INIT_SKIP_NAMES = frozenset(['.git', '.gitignore', '.gitmodules', '.potignore'])
+# files with gitignore(5) patterns of entries skipped by init
+IGNORE_FILES = ('.gitignore', '.potignore')
+# directories shared by many programs, their entries are discovered as separate dotfiles with nested targets
+CONTAINER_DIRS = frozenset(['.config', '.local', '.local/bin', '.local/share', '.local/state'])
+# advisory lock of pot repository, see file_lock()
+LOCK_NAME = '.lock'
+LOCKS_DIR = '.locks'
+# default limits of hooks run around installation, see run_hooks()
+HOOK_TIMEOUT = 300
+HOOK_JOBS = os.cpu_count() or 1
+HOOK_STAGES = ('pre_install', 'post_install')
+# first member of bundle archive describing its content
+BUNDLE_INDEX_NAME = 'pot-bundle.json'
+BUNDLE_VERSION = 1
+DEFAULT_BUNDLE_NAME = 'pot-bundle.tar.gz'
+# directories scanned by previous init, stored in the root of pot repository
+INIT_CACHE_NAME = '.init.cache'
+INIT_CACHE_VERSION = 1
+# placeholders of template dotfiles, e.g. {{ hostname }} or {{ git.email }}
+TEMPLATE_PLACEHOLDER = r'\{\{\s*([A-Za-z_][\w.]*)\s*\}\}'
+# inotify(7) event flags used by watch mode
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_EVENTS = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+# ioctl request cloning content of one file into another on CoW file systems (btrfs, xfs)
+FICLONE = 0x40049409
 
 
 class RangeFilter(logging.Filter):
@@ -59,38 +157,881 @@ logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.NullHandler())
 logger.propagate = False
 
-info_handler = logging.StreamHandler(sys.stdout)
-info_handler.addFilter(RangeFilter(minlevel=logging.INFO, maxlevel=logging.INFO))
-logger.addHandler(info_handler)
 
-error_handler = logging.StreamHandler()
-error_handler.setLevel(logging.ERROR)
-error_handler.setFormatter(fmt=logging.Formatter('[%(levelname)s] %(message)s'))
-logger.addHandler(error_handler)
+def setup_logging(verbose=False, quiet=False):
+    """Attach console handlers to logger, it's done only when pot is used as a command.
+
+    In quiet mode only errors are reported and messages about actions aren't even formatted.
+    """
+    global _quiet_mode
+    _quiet_mode = quiet
+    if quiet:
+        logger.setLevel(logging.ERROR)
+    else:
+        info_handler = logging.StreamHandler(sys.stdout)
+        info_handler.addFilter(RangeFilter(minlevel=logging.INFO, maxlevel=logging.INFO))
+        logger.addHandler(info_handler)
+
+    error_handler = logging.StreamHandler()
+    error_handler.setLevel(logging.ERROR)
+    error_handler.setFormatter(fmt=logging.Formatter('[%(levelname)s] %(message)s'))
+    logger.addHandler(error_handler)
+
+    if verbose and not quiet:
+        debug_handler = logging.StreamHandler()
+        debug_handler.addFilter(RangeFilter(minlevel=logging.DEBUG, maxlevel=logging.DEBUG))
+        debug_handler.setFormatter(logging.Formatter(VERBOSE_MESSAGE_FORMAT))
+        logger.addHandler(debug_handler)
+
+
+class DeferredOutput(logging.Filter):
+    """Holds back records logged by worker threads so that they can be replayed in order."""
+
+    def __init__(self, name=''):
+        super(DeferredOutput, self).__init__(name)
+        self._local = threading.local()
+
+    def filter(self, record):
+        records = getattr(self._local, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+    @contextmanager
+    def capture(self):
+        records = []
+        self._local.records = records
+        try:
+            yield records
+        finally:
+            self._local.records = None
+
+
+deferred_output = DeferredOutput()
+logger.addFilter(deferred_output)
 
 _quiet_mode = False
 
 
+class EventStream(object):
+    """Writes JSON record per action (one line each) for machine consumption.
+
+    Records are buffered and written in batches. Without stream they are only collected
+    in records list, e.g. to be passed from worker process.
+    """
+
+    def __init__(self, stream=None, buffer_size=256):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.records = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path):
+        """Open stream writing to file or to stdout if path is '-'."""
+        return cls(sys.stdout if path == '-' else open(path, 'a', buffering=1 << 16))
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields.setdefault('time', time.time())
+        with self._lock:
+            self.records.append(fields)
+            if self.stream is not None and len(self.records) >= self.buffer_size:
+                self._write()
+
+    def action(self, event, target, action, outcome, start, written=0, **fields):
+        """Emit record of finished action, start is its time.perf_counter()."""
+        self.emit(event, target=target, action=action, outcome=outcome,
+                  duration=round(time.perf_counter() - start, 6), bytes=written, **fields)
+
+    def _write(self):
+        self.stream.write(''.join(json.dumps(record, sort_keys=True) + '\n' for record in self.records))
+        self.records = []
+
+    def flush(self):
+        with self._lock:
+            if self.stream is not None:
+                self._write()
+                self.stream.flush()
+
+    def close(self):
+        self.flush()
+        if self.stream not in (None, sys.stdout):
+            self.stream.close()
+
+
+# event stream of running command, see EventStream
+events = None
+
+
+def print_result(line):
+    """Print line of command output (e.g. plan or status), to stderr if events are streamed to stdout."""
+    print(line, file=sys.stderr if events is not None and events.stream is sys.stdout else sys.stdout)
+
+
+class Profiler(object):
+    """Collects durations of named phases for summary table and Chrome trace."""
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+
+    @contextmanager
+    def phase(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.events.append((name, threading.current_thread().ident, start, time.perf_counter(), args))
+
+    def summary(self):
+        """Return (phase, calls, total, max) rows sorted by total time."""
+        rows = {}
+        for name, _, start, end, _ in self.events:
+            calls, total, longest = rows.get(name, (0, 0.0, 0.0))
+            rows[name] = (calls + 1, total + end - start, max(longest, end - start))
+        return sorted(((name,) + row for name, row in rows.items()), key=lambda row: -row[2])
+
+    def print_summary(self, stream=None):
+        stream = sys.stderr if stream is None else stream
+        stream.write('{:<24} {:>8} {:>10} {:>10} {:>10}\n'.format('phase', 'calls', 'total ms', 'mean ms', 'max ms'))
+        for name, calls, total, longest in self.summary():
+            stream.write('{:<24} {:>8} {:>10.2f} {:>10.3f} {:>10.3f}\n'.format(
+                name, calls, total * 1000, total * 1000 / calls, longest * 1000))
+
+    def write_trace(self, path):
+        """Save collected phases in Chrome trace event format (chrome://tracing, Perfetto)."""
+        pid = os.getpid()
+        events = [{
+            'name': name,
+            'cat': 'pot',
+            'ph': 'X',
+            'ts': (start - self.origin) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': pid,
+            'tid': tid,
+            'args': args
+        } for name, tid, start, end, args in self.events]
+        with open(path, 'w') as fd:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fd)
+
+
+# enabled by --timings and --trace options
+profiler = None
+_no_timing = nullcontext()
+
+
+def timed(phase, **args):
+    """Measure duration of the phase if profiling is enabled."""
+    if profiler is None:
+        return _no_timing
+    return profiler.phase(phase, **args)
+
+
 def real_dir(path):
-    """Check that path refers to real directory, not symlink to it."""
+    """Check that path (or os.DirEntry) refers to real directory, not symlink to it."""
+    if isinstance(path, os.DirEntry):
+        return path.is_dir(follow_symlinks=False)
     return not os.path.islink(path) and os.path.isdir(path)
 
 
 def real_file(path):
-    """Check that path refers to real file, not symlink to it."""
+    """Check that path (or os.DirEntry) refers to real file, not symlink to it."""
+    if isinstance(path, os.DirEntry):
+        return path.is_file(follow_symlinks=False)
     return not os.path.islink(path) and os.path.isfile(path)
 
 
 def broken_link(path):
-    """Check that path refers to broken symbolic link."""
+    """Check that path (or os.DirEntry) refers to broken symbolic link."""
+    if isinstance(path, os.DirEntry):
+        return path.is_symlink() and not os.path.exists(path.path)
     return os.path.islink(path) and not os.path.exists(path)
 
 
 def same_file_symlink(link, file):
-    """Check that dst is symlink pointing to dst."""
+    """Check that link (path or os.DirEntry) is symlink pointing to file."""
+    if isinstance(link, os.DirEntry):
+        # pot creates symlinks with absolute paths, reading one is enough in most cases
+        if not link.is_symlink():
+            return False
+        if os.readlink(link.path) == file:
+            return True
+        link = link.path
     return os.path.islink(link) and os.path.exists(link) and os.path.samefile(file, link)
 
 
+def scan_targets(targets):
+    """Map absolute paths to os.DirEntry objects (None for missing ones).
+
+    Paths are grouped by parent directory and each directory is listed only once,
+    so file types come from a single os.scandir call instead of a stat per path.
+    """
+    by_parent = {}
+    for target in targets:
+        by_parent.setdefault(os.path.dirname(target), set()).add(os.path.basename(target))
+    entries = {}
+    for parent, names in by_parent.items():
+        found = {}
+        try:
+            for entry in os.scandir(parent):
+                if entry.name in names:
+                    found[entry.name] = entry
+        except OSError as e:
+            logger.debug('Can\'t list "%s": %s', parent, e)
+        for name in names:
+            entries[os.path.join(parent, name)] = found.get(name)
+    return entries
+
+
+def find_inclusions(path, lines):
+    """Find which of the lines (ignoring surrounding whitespaces) file already contains.
+
+    File is read line by line, so it's never loaded in memory entirely. Returns set of found
+    lines and flag telling whether file ends with a newline.
+    """
+    found = set()
+    last = '\n'
+    with open(path) as fd:
+        for existing in fd:
+            last = existing
+            existing = existing.strip()
+            if existing in lines:
+                found.add(existing)
+    return found, last.endswith('\n')
+
+
+def has_inclusion(path, line):
+    """Check that file contains given line (ignoring surrounding whitespaces)."""
+    return line in find_inclusions(path, {line})[0]
+
+
+class Inclusions(object):
+    """Lines appended by 'include' action, grouped by target file.
+
+    Every target is scanned once for all inclusion lines of the installed dotfiles, and all
+    missing lines are appended to it with a single write on flush(). Targets already scanned
+    by planning are given with their results of find_inclusions() as found and aren't read again.
+    """
+
+    def __init__(self, lines=(), found=None):
+        self.wanted = {}
+        for dst, line in lines:
+            self.wanted.setdefault(dst, set()).add(line)
+        self.found = {} if found is None else found
+        self.pending = OrderedDict()
+        self.included = OrderedDict()
+
+    def include(self, dotfile, src, dst, line):
+        """Schedule appending of inclusion line. Returns False if target already contains it."""
+        if dst not in self.found:
+            logger.debug('checking for previous inclusions in "%s"...', dst)
+            wanted = self.wanted.setdefault(dst, set())
+            wanted.add(line)
+            self.found[dst] = find_inclusions(dst, wanted)
+        self.included.setdefault(dst, []).append((dotfile, src))
+        found, _ = self.found[dst]
+        if line in found:
+            return False
+        found.add(line)
+        self.pending.setdefault(dst, []).append(line)
+        return True
+
+    def flush(self, manifest):
+        """Append all scheduled lines and record included dotfiles in manifest."""
+        for dst, included in self.included.items():
+            lines = self.pending.get(dst)
+            if lines:
+                _, newline_ended = self.found[dst]
+                logger.debug('Appending %d lines to "%s"', len(lines), dst)
+                with report_action(), timed('install.include', target=dst):
+                    with open(dst, 'a') as target:
+                        target.write(('' if newline_ended else '\n') + '\n'.join(lines) + '\n')
+                # dotfiles included before are still there
+                manifest.refresh(dst)
+            for dotfile, src in included:
+                manifest.record(dotfile, src, dst)
+        self.found.clear()
+        self.pending.clear()
+        self.included.clear()
+
+
+def iter_tree(path, exclude=()):
+    """Yield (relative path, lstat result) pairs for path and everything below it, sorted by name.
+
+    Entries named as one of exclude are skipped together with everything below them.
+    """
+
+    def walk(top, prefix):
+        for entry in sorted(os.scandir(top), key=lambda e: e.name):
+            if entry.name in exclude:
+                continue
+            relpath = os.path.join(prefix, entry.name)
+            yield relpath, entry.stat(follow_symlinks=False)
+            if entry.is_dir(follow_symlinks=False):
+                for item in walk(entry.path, relpath):
+                    yield item
+
+    st = os.lstat(path)
+    yield '', st
+    if stat.S_ISDIR(st.st_mode):
+        for item in walk(path, ''):
+            yield item
+
+
+def source_signature(path):
+    """Compute cheap stat-based signature of a file or a whole directory tree."""
+    digest = hashlib.sha1()
+    for relpath, st in iter_tree(path):
+        digest.update('{}\0{:o}\0{}\0{}\n'.format(relpath, st.st_mode, st.st_size, st.st_mtime_ns).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def content_digest(path, hash_cache=None):
+    """Compute digest of content of a file or a whole directory tree.
+
+    Digests of files are taken from hash_cache if it's given, files missing in it are hashed
+    in parallel.
+    """
+    hash_cache = HashCache() if hash_cache is None else hash_cache
+    items = [(relpath, os.path.join(path, relpath) if relpath else path, st) for relpath, st in iter_tree(path)]
+    files = hash_cache.digests([(filename, st) for _, filename, st in items if stat.S_ISREG(st.st_mode)])
+    digest = hashlib.sha1()
+    for relpath, filename, st in items:
+        digest.update('{}\0{:o}\n'.format(relpath, stat.S_IFMT(st.st_mode)).encode('utf-8'))
+        if stat.S_ISREG(st.st_mode):
+            digest.update(files[filename].encode('ascii'))
+        elif stat.S_ISLNK(st.st_mode):
+            digest.update(os.readlink(filename).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    """Compute SHA-1 of file content, large files are hashed in chunks through memory map.
+
+    hashlib releases GIL while hashing large chunks, so many files can be hashed by threads in parallel.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if size < MMAP_MIN_SIZE:
+            digest.update(fd.read())
+            return digest.hexdigest()
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, len(view), HASH_CHUNK_SIZE):
+                    digest.update(view[offset:offset + HASH_CHUNK_SIZE])
+            finally:
+                view.release()
+    return digest.hexdigest()
+
+
+def mtime_trusted(st):
+    """Check that file with stat result st wasn't modified just before it was read (see MTIME_GRANULARITY_NS)."""
+    return time.time_ns() - st.st_mtime_ns > MTIME_GRANULARITY_NS
+
+
+class HashCache(object):
+    """Digests of files keyed by path and remembered along with inode, size and modification time.
+
+    Unchanged files are never read again, the cache is kept between runs if path is given.
+    """
+
+    def __init__(self, path=None, jobs=None):
+        self.path = path
+        self.jobs = jobs
+        self._entries = None
+        self._lock = threading.Lock()
+        self.modified = False
+
+    def __str__(self):
+        return '<HashCache: {}>'.format(self.path)
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def entries(self):
+        with self._lock:
+            if self._entries is None:
+                self._entries = {}
+                if self.path is not None:
+                    try:
+                        with open(self.path) as fd:
+                            data = json.load(fd)
+                        if data.get('version') == HASH_CACHE_VERSION:
+                            self._entries = data.get('entries', {})
+                    except (IOError, OSError, ValueError) as e:
+                        logger.debug('Hash cache "%s" is not loaded: %s', self.path, e)
+            return self._entries
+
+    def save(self):
+        with self._lock:
+            if not self.modified or self.path is None:
+                return
+            with atomic_write(self.path) as fd:
+                json.dump({'version': HASH_CACHE_VERSION, 'entries': self._entries}, fd)
+            self.modified = False
+
+    def lookup(self, path, st):
+        entry = self.entries.get(path)
+        if entry is not None and entry[:3] == [st.st_ino, st.st_size, st.st_mtime_ns]:
+            return entry[3]
+        return None
+
+    def _hash(self, path, st):
+        with timed('hash', path=path):
+            digest = file_digest(path)
+        if mtime_trusted(st):
+            with self._lock:
+                self._entries[path] = [st.st_ino, st.st_size, st.st_mtime_ns, digest]
+                self.modified = True
+        return digest
+
+    def digest(self, path, st=None):
+        """Return digest of file content, st is its stat result if it's already known."""
+        path = os.path.abspath(path)
+        st = os.stat(path) if st is None else st
+        digest = self.lookup(path, st)
+        return self._hash(path, st) if digest is None else digest
+
+    def digests(self, files):
+        """Return mapping of paths to digests for (path, stat result) pairs using pool of threads for misses."""
+        result = {}
+        missing = []
+        for path, st in files:
+            digest = self.lookup(os.path.abspath(path), st)
+            if digest is None:
+                missing.append((path, st))
+            else:
+                result[path] = digest
+        if len(missing) > 1 and self.jobs != 1 and sum(st.st_size for _, st in missing) >= MMAP_MIN_SIZE:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(self.jobs) as executor:
+                digests = executor.map(lambda item: self._hash(os.path.abspath(item[0]), item[1]), missing)
+                result.update(zip((path for path, _ in missing), digests))
+        else:
+            for path, st in missing:
+                result[path] = self._hash(os.path.abspath(path), st)
+        return result
+
+
+def current_umask():
+    """Read umask of the process without changing it (os.umask() would race with other threads)."""
+    try:
+        with open('/proc/self/status') as fd:
+            for line in fd:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (IOError, OSError, ValueError):
+        pass
+    return 0o022
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """Write file through temporary file in the same directory renamed over path on success.
+
+    Readers never see partially written file. Permissions of the replaced file are kept,
+    new file gets the default ones. Symlinked path is written through, its target is replaced.
+    """
+    path = os.path.realpath(path)
+    fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=os.path.dirname(path) or '.')
+    try:
+        try:
+            permissions = stat.S_IMODE(os.stat(path).st_mode)
+        except OSError:
+            permissions = 0o666 & ~current_umask()
+        os.fchmod(fd, permissions)
+        with os.fdopen(fd, mode) as stream:
+            yield stream
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+@contextmanager
+def file_lock(path, exclusive=True):
+    """Hold advisory flock(2) lock of the file (it's created if necessary) waiting for it if needed.
+
+    Lock is shared if exclusive is False. If the file can't be opened at all, e.g. in read-only
+    repository, nothing is locked.
+    """
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    except OSError:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            logger.debug('"%s" is not locked: %s', path, e)
+            yield
+            return
+    try:
+        with timed('lock', path=path, exclusive=exclusive):
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        # closing the descriptor releases the lock
+        os.close(fd)
+
+
+def clone_file_content(src_fd, dst_fd, size):
+    """Copy content between file descriptors as cheap as file system allows.
+
+    Reflinks are tried first, then in-kernel copy_file_range(2) and finally plain
+    buffered copy if neither is supported.
+    """
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return
+    except (IOError, OSError) as e:
+        logger.debug('Reflink is not supported: %s', e)
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    copied = 0
+    if copy_file_range is not None:
+        try:
+            while copied < size:
+                n = copy_file_range(src_fd, dst_fd, size - copied)
+                if n == 0:
+                    break
+                copied += n
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP) or copied:
+                raise
+            logger.debug('copy_file_range is not supported: %s', e)
+    while True:
+        chunk = os.read(src_fd, 1 << 20)
+        if not chunk:
+            break
+        os.write(dst_fd, chunk)
+
+
+def copy_file(src, dst, stat_src=None):
+    """Atomically replace dst with the copy of src preserving its mode and modification time.
+
+    Mode and modification time are taken from stat_src instead if it's given.
+    """
+    st = os.stat(src)
+    fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(dst) + '.', dir=os.path.dirname(dst))
+    try:
+        with open(src, 'rb') as src_file:
+            clone_file_content(src_file.fileno(), fd, st.st_size)
+        os.close(fd)
+        fd = None
+        shutil.copystat(stat_src or src, temp_path)
+        os.replace(temp_path, dst)
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        os.remove(temp_path)
+        raise
+    return st.st_size
+
+
+def same_content(path1, path2):
+    with open(path1, 'rb') as fd1, open(path2, 'rb') as fd2:
+        while True:
+            chunk1, chunk2 = fd1.read(1 << 16), fd2.read(1 << 16)
+            if chunk1 != chunk2:
+                return False
+            if not chunk1:
+                return True
+
+
+def remove_path(path):
+    # os.path.isdir always follows symlinks
+    if real_dir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def sync_tree(src, dst, store=None):
+    """Make dst a copy of src writing only files that differ, like rsync does.
+
+    Files are compared by size and modification time first. If only modification time differs,
+    content is compared and the file is rewritten only if it actually changed. Entries absent in
+    src are removed from dst. Large files are cloned from the object store if it's given.
+    Returns number of written bytes.
+    """
+    src_st = os.lstat(src)
+    try:
+        dst_st = os.lstat(dst)
+    except OSError:
+        dst_st = None
+    written = 0
+    if stat.S_ISLNK(src_st.st_mode):
+        link = os.readlink(src)
+        if dst_st is not None and stat.S_ISLNK(dst_st.st_mode) and os.readlink(dst) == link:
+            return written
+        if dst_st is not None:
+            remove_path(dst)
+        logger.debug('Symlinking "%s" -> "%s"', dst, link)
+        os.symlink(link, dst)
+    elif stat.S_ISDIR(src_st.st_mode):
+        if dst_st is not None and not stat.S_ISDIR(dst_st.st_mode):
+            remove_path(dst)
+            dst_st = None
+        if dst_st is None:
+            logger.debug('Creating directory "%s"', dst)
+            os.makedirs(dst)
+        names = set()
+        for entry in os.scandir(src):
+            names.add(entry.name)
+            written += sync_tree(entry.path, os.path.join(dst, entry.name), store)
+        for entry in os.scandir(dst):
+            if entry.name not in names:
+                logger.debug('Removing "%s"', entry.path)
+                remove_path(entry.path)
+        shutil.copymode(src, dst)
+    else:
+        if dst_st is not None and stat.S_ISREG(dst_st.st_mode) and dst_st.st_size == src_st.st_size:
+            if dst_st.st_mtime_ns == src_st.st_mtime_ns:
+                return written
+            if same_content(src, dst):
+                logger.debug('Updating modification time of "%s"', dst)
+                shutil.copystat(src, dst)
+                return written
+        if dst_st is not None and not stat.S_ISREG(dst_st.st_mode):
+            remove_path(dst)
+        if store is not None and src_st.st_size >= STORE_MIN_SIZE:
+            logger.debug('Cloning "%s" to "%s" from object store', src, dst)
+            written += store.materialize(src, dst)
+        else:
+            logger.debug('Copying "%s" to "%s"', src, dst)
+            written += copy_file(src, dst)
+    return written
+
+
+def host_variables(home=None):
+    """Built-in variables of template dotfiles, 'user' of explicit home is its owner."""
+    user = os.environ.get('USER', '')
+    if home is not None:
+        try:
+            user = pwd.getpwuid(os.stat(home).st_uid).pw_name
+        except (KeyError, OSError) as e:
+            logger.debug('Owner of "%s" is unknown: %s', home, e)
+    return {
+        'hostname': os.uname()[1],
+        'user': user,
+        'home': os.path.expanduser('~') if home is None else os.path.abspath(home)
+    }
+
+
+def variables_digest(variables):
+    return hashlib.sha1(json.dumps(variables, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def render_template(text, variables, name='<template>'):
+    """Substitute {{ name }} placeholders of the template, dotted names look into nested mappings."""
+
+    def substitute(match):
+        value = variables
+        for key in match.group(1).split('.'):
+            if not isinstance(value, dict) or key not in value:
+                raise ValueError('Undefined variable "{}" in template "{}"'.format(match.group(1), name))
+            value = value[key]
+        return str(value)
+
+    return re.sub(TEMPLATE_PLACEHOLDER, substitute, text)
+
+
+def render_file(src, dst, variables):
+    """Render template src into dst, the target is rewritten only if rendered content differs.
+
+    Returns number of written bytes.
+    """
+    with open(src, 'rb') as fd:
+        content = render_template(fd.read().decode('utf-8'), variables, src).encode('utf-8')
+    if real_file(dst) and os.path.getsize(dst) == len(content):
+        with open(dst, 'rb') as fd:
+            if fd.read() == content:
+                logger.debug('Rendered "%s" is not changed', dst)
+                return 0
+    with atomic_write(dst, 'wb') as fd:
+        fd.write(content)
+        # large templates are linked to read-only objects of the store
+        os.fchmod(fd.fileno(), stat.S_IMODE(os.stat(src).st_mode) | stat.S_IWUSR)
+    return len(content)
+
+
+def file_system(path):
+    """Device of the file system path is (or would be created) on."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+
+class ObjectStore(object):
+    """Content-addressed store of large files of pot repository.
+
+    Objects are named by SHA-1 of their content and kept read-only, so files hardlinked to them
+    can't be changed in place: editors replacing the file just break the link. That's why only
+    sources of copied and rendered dotfiles are linked to the store, symlinked ones are edited
+    through their targets. Digests of stored files are remembered in the index keyed by device,
+    inode, size and modification time, so a known file isn't read again to find its object.
+    Entries of removed and replaced files are pruned when the index is saved.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = os.path.join(path, STORE_INDEX_NAME)
+        self._index = None
+        self._lock = threading.Lock()
+        self.modified = False
+
+    def __str__(self):
+        return '<ObjectStore: {}>'.format(self.path)
+
+    def __repr__(self):
+        return self.__str__()
+
+    @classmethod
+    def for_repo(cls, repo):
+        """Store of pot repository, the one in $POT_HOME is shared by all repositories on its file system.
+
+        Objects are hardlinked to sources, so repository on another file system keeps its own store.
+        """
+        shared = os.path.join(os.path.expanduser(os.getenv('POT_HOME', DEFAULT_POT_HOME)), STORE_DIR)
+        if file_system(repo) == file_system(shared):
+            return cls(shared)
+        logger.debug('"%s" is on another file system than "%s", using store of the repository', repo, shared)
+        return cls(os.path.join(repo, STORE_DIR))
+
+    @property
+    def index(self):
+        with self._lock:
+            if self._index is None:
+                try:
+                    with open(self.index_path) as fd:
+                        self._index = json.load(fd)
+                except (IOError, OSError, ValueError) as e:
+                    logger.debug('Store index "%s" is not loaded: %s', self.index_path, e)
+                    self._index = {}
+            return self._index
+
+    def prune(self):
+        """Drop index entries of files which were removed or changed since they were hashed."""
+        index = self.index
+        with self._lock:
+            for key, entry in list(index.items()):
+                try:
+                    st = os.lstat(entry[3])
+                except (IndexError, OSError):
+                    st = None
+                if st is None or '{}:{}'.format(st.st_dev, st.st_ino) != key or \
+                        entry[:2] != [st.st_size, st.st_mtime_ns]:
+                    del index[key]
+                    self.modified = True
+
+    def save(self):
+        if self.modified:
+            self.prune()
+        with self._lock:
+            if not self.modified:
+                return
+            with atomic_write(self.index_path) as fd:
+                json.dump(self._index, fd)
+            self.modified = False
+
+    def object_path(self, digest, executable=False):
+        # objects differing only in executable bit can't share inode
+        return os.path.join(self.path, digest[:2], digest[2:] + ('x' if executable else ''))
+
+    def digest(self, path, st):
+        key = '{}:{}'.format(st.st_dev, st.st_ino)
+        entry = self.index.get(key)
+        if entry is not None and entry[:2] == [st.st_size, st.st_mtime_ns]:
+            return entry[2]
+        with timed('store.hash', path=path):
+            digest = file_digest(path)
+        if mtime_trusted(st):
+            with self._lock:
+                self._index[key] = [st.st_size, st.st_mtime_ns, digest, os.path.abspath(path)]
+                self.modified = True
+        return digest
+
+    def put(self, path):
+        """Add content of regular file to the store unless it's already there. Returns path of the object."""
+        st = os.stat(path)
+        executable = bool(st.st_mode & stat.S_IXUSR)
+        digest = self.digest(path, st)
+        object_path = self.object_path(digest, executable)
+        if not os.path.exists(object_path):
+            if not os.path.isdir(os.path.dirname(object_path)):
+                os.makedirs(os.path.dirname(object_path))
+            with timed('store.put', path=path), atomic_write(object_path, 'wb') as fd:
+                with open(path, 'rb') as src_file:
+                    clone_file_content(src_file.fileno(), fd.fileno(), st.st_size)
+                os.fchmod(fd.fileno(), 0o555 if executable else 0o444)
+            # files hardlinked to the object are recognized without reading them
+            object_st = os.stat(object_path)
+            with self._lock:
+                self._index['{}:{}'.format(object_st.st_dev, object_st.st_ino)] = [
+                    object_st.st_size, object_st.st_mtime_ns, digest, object_path]
+                self.modified = True
+        return object_path
+
+    def link(self, path):
+        """Replace file with hardlink to its object. Returns False if file can't share the object."""
+        object_path = self.put(path)
+        if os.path.samefile(path, object_path):
+            return False
+        temp_path = '{}.{}.pot'.format(path, os.getpid())
+        try:
+            os.link(object_path, temp_path)
+        except OSError as e:
+            logger.debug('"%s" is not linked to the store: %s', path, e)
+            return False
+        os.replace(temp_path, path)
+        return True
+
+    def dedupe(self, path):
+        """Link large file or all large files below path (except git metadata) to the store.
+
+        Returns number of saved bytes.
+        """
+        if real_dir(path):
+            filenames = []
+            for root, dirs, files in os.walk(path):
+                dirs[:] = [name for name in dirs if name != '.git']
+                filenames.extend(os.path.join(root, name) for name in files)
+        else:
+            filenames = [path]
+        saved = 0
+        for filename in filenames:
+            st = os.lstat(filename)
+            if stat.S_ISREG(st.st_mode) and st.st_size >= STORE_MIN_SIZE and self.link(filename):
+                saved += st.st_size
+        return saved
+
+    def materialize(self, src, dst):
+        """Clone object of src into dst keeping modification time of src. Returns size of the file.
+
+        Unlike the object, dst is left writable by user.
+        """
+        size = copy_file(self.put(src), dst, stat_src=src)
+        os.chmod(dst, stat.S_IMODE(os.stat(src).st_mode) | stat.S_IWUSR)
+        return size
+
+
+def yaml_loader():
+    """Use fast LibYAML based loader if PyYAML was built with it."""
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def yaml_dumper():
+    return getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
 def yaml_scalar(value):
     return yaml.ScalarNode(tag='tag:yaml.org,2002:str', value=value)
 
@@ -103,6 +1044,54 @@ def yaml_seq(elems):
     return yaml.SequenceNode(tag='tag:yaml.org,2002:seq', value=elems)
 
 
+def as_list(value):
+    """Allow single value where list is expected in configuration file."""
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def merge_variables(base, override):
+    """Merge nested mappings of variables, values of override win."""
+    result = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(result.get(key), dict):
+            value = merge_variables(result[key], value)
+        result[key] = value
+    return result
+
+
+def file_key(path):
+    """Return [absolute path, inode, size, modification time, digest, trusted] of the file with its content.
+
+    Stat of trusted file is enough to tell it's unchanged, see mtime_trusted().
+    """
+    with open(path, 'rb') as fd:
+        st = os.fstat(fd.fileno())
+        content = fd.read()
+    return [os.path.abspath(path), st.st_ino, st.st_size, st.st_mtime_ns, hashlib.sha1(content).hexdigest(),
+            mtime_trusted(st)], content
+
+
+def file_unchanged(key):
+    """Check that file is the same as when its key was taken, it's read only if its stat isn't conclusive."""
+    try:
+        st = os.stat(key[0])
+    except OSError:
+        return False
+    if key[5] and [st.st_ino, st.st_size, st.st_mtime_ns] == key[1:4]:
+        return True
+    try:
+        return file_key(key[0])[0][4] == key[4]
+    except (IOError, OSError):
+        return False
+
+
+def yaml_node(value):
+    """Represent arbitrary plain data (e.g. template variables) as YAML node."""
+    return yaml.representer.SafeRepresenter().represent_data(value)
+
+
 @contextmanager
 def cd(path):
     old_cwd = os.getcwd()
@@ -116,9 +1105,14 @@ def cd(path):
 
 
 @contextmanager
-def report_action(description=None, suppress=False):
-    if description is not None:
-        print(description)
+def report_action(description=None, *args, **kwargs):
+    """Log description of action formatted with args (unless in quiet mode) and report its failure.
+
+    Exception is reraised unless suppress keyword argument is True.
+    """
+    suppress = kwargs.pop('suppress', False)
+    if description is not None and not _quiet_mode:
+        logger.info(description.format(*args))
     try:
         yield
     except Exception as e:
@@ -130,23 +1124,31 @@ def report_action(description=None, suppress=False):
 class DotFile(object):
     """Represents single dotfile stored in repo.
 
-    name   - name of the dotfile in repository
-    target - name of the file in system
-    action - action for placing dotfile in system. Can be one of symlink/copy/include.
+    name         - name of the dotfile in repository
+    target       - name of the file in system
+    action       - action for placing dotfile in system. Can be one of symlink/copy/include/template.
+    pre_install  - hooks run before the dotfile is (re)installed, see parse_hooks()
+    post_install - hooks run after the dotfile was (re)installed
     """
 
-    def __init__(self, name, target=None, action='symlink'):
+    def __init__(self, name, target=None, action='symlink', pre_install=None, post_install=None):
         self.name = name
         self.target = os.path.join('~', name) if target is None else target
         self.action = action
+        self.pre_install = pre_install
+        self.post_install = post_install
 
     def _as_yaml_node(self):
         # It needs to be done manually to preserve order of key-value pairs
-        return yaml_map([
+        items = [
             (yaml_scalar('name'), yaml_scalar(self.name)),
             (yaml_scalar('target'), yaml_scalar(self.target)),
             (yaml_scalar('action'), yaml_scalar(self.action))
-        ])
+        ]
+        for key in HOOK_STAGES:
+            if getattr(self, key):
+                items.append((yaml_scalar(key), yaml_node(getattr(self, key))))
+        return yaml_map(items)
 
     def to_yaml(self, stream=None):
         return yaml.serialize(self._as_yaml_node(), stream)
@@ -159,17 +1161,42 @@ class DotFile(object):
         return self.__str__()
 
     def __eq__(self, other):
-        return self.name == other.name and self.target == other.target and self.action == other.action
+        if not isinstance(other, DotFile):
+            return NotImplemented
+        return (self.name == other.name and self.target == other.target and self.action == other.action and
+                self.pre_install == other.pre_install and self.post_install == other.post_install)
+
+    def __ne__(self, other):
+        return not self == other
 
     def __hash__(self):
         return hash(self.name) ^ hash(self.target) ^ hash(self.action)
 
 
 class Config(object):
-    """Represents content of 'config.yaml' (dotfiles and settings)."""
+    """Represents content of 'config.yaml' (dotfiles and settings).
+
+    variables - variables of template dotfiles
+    hosts     - variables overridden on particular hosts, keyed by host name
+    profiles  - named layers of configuration applied on top of it, see ConfigResolver
+    includes  - paths of configuration files merged before this one
+    excludes  - names of dotfiles of the included files dropped by this one
+    store     - whether large files are deduplicated through the object store
+    hooks     - global 'pre_install' and 'post_install' hooks, see parse_hooks()
+    sources   - absolute paths of the files configuration was loaded from, see Config.load()
+    """
 
-    def __init__(self, dotfiles):
+    def __init__(self, dotfiles, variables=None, hosts=None, profiles=None, includes=None, store=False,
+                 hooks=None, excludes=None):
         self.dotfiles = dotfiles
+        self.store = store
+        self.hooks = {} if hooks is None else hooks
+        self.variables = {} if variables is None else variables
+        self.hosts = {} if hosts is None else hosts
+        self.profiles = {} if profiles is None else profiles
+        self.includes = [] if includes is None else includes
+        self.excludes = [] if excludes is None else excludes
+        self.sources = []
 
     def __str__(self):
         attrs = dict(self.__dict__)
@@ -179,159 +1206,2396 @@ class Config(object):
     def __repr__(self):
         return self.__str__()
 
+    def _yaml_items(self):
+        """Return nodes of settings placed before and after the list of dotfiles."""
+        head = []
+        if self.includes:
+            head.append((yaml_scalar('include'), yaml_node(self.includes)))
+        if self.excludes:
+            head.append((yaml_scalar('exclude'), yaml_node(self.excludes)))
+        if self.store:
+            head.append((yaml_scalar('store'), yaml_node(True)))
+        tail = []
+        if self.variables:
+            tail.append((yaml_scalar('variables'), yaml_node(self.variables)))
+        if self.hosts:
+            tail.append((yaml_scalar('hosts'), yaml_node(self.hosts)))
+        if self.profiles:
+            tail.append((yaml_scalar('profiles'), yaml_node(self.profiles)))
+        for key in HOOK_STAGES:
+            if self.hooks.get(key):
+                tail.append((yaml_scalar(key), yaml_node(self.hooks[key])))
+        return head, tail
+
     def _as_yaml_node(self):
-        return yaml_map([
-            (yaml_scalar('dotfiles'), yaml_seq(map(DotFile._as_yaml_node, self.dotfiles)))
-        ])
+        head, tail = self._yaml_items()
+        dotfiles = yaml_seq([df._as_yaml_node() for df in self.dotfiles])
+        return yaml_map(head + [(yaml_scalar('dotfiles'), dotfiles)] + tail)
+
+    def write(self, stream, dotfiles=None):
+        """Write configuration serializing dotfiles one by one, as soon as they are produced.
+
+        dotfiles iterable (e.g. generator of discovered dotfiles) replaces dotfiles of the configuration.
+        """
+        dotfiles = iter(self.dotfiles if dotfiles is None else dotfiles)
+        head, tail = self._yaml_items()
+        dumper = yaml_dumper()
+        if head:
+            yaml.serialize(yaml_map(head), stream, Dumper=dumper)
+        first = next(dotfiles, None)
+        if first is None:
+            stream.write('dotfiles: []\n')
+        else:
+            stream.write('dotfiles:\n')
+            yaml.serialize(yaml_seq([first._as_yaml_node()]), stream, Dumper=dumper)
+            for dotfile in dotfiles:
+                yaml.serialize(yaml_seq([dotfile._as_yaml_node()]), stream, Dumper=dumper)
+        if tail:
+            yaml.serialize(yaml_map(tail), stream, Dumper=dumper)
 
     @classmethod
     def from_yaml(cls, stream):
-        d = yaml.load(stream)
+        """Parse single configuration file, neither includes nor profiles are resolved."""
+        d = yaml.load(stream, Loader=yaml_loader())
         dotfiles = [DotFile(**df) for df in d.get('dotfiles', [])]
-        return cls(dotfiles)
+        hooks = {key: d[key] for key in HOOK_STAGES if d.get(key)}
+        return cls(dotfiles, d.get('variables'), d.get('hosts'), d.get('profiles'), as_list(d.get('include')),
+                   bool(d.get('store')), hooks, as_list(d.get('exclude')))
+
+    def template_variables(self, home=None):
+        """Collect variables of template dotfiles for current host.
+
+        Built-in 'hostname', 'user' and 'home' are overridden by global variables which
+        in turn are overridden by variables of the host.
+        """
+        variables = merge_variables(host_variables(home), self.variables)
+        return merge_variables(variables, self.hosts.get(variables['hostname'], {}))
+
+    @classmethod
+    def load(cls, path, profile=None):
+        """Load configuration file resolved for profile through the cache of previous resolutions.
+
+        Every profile is cached separately and keyed by inode, size, modification time and digest
+        of all the files it was resolved from, so it's invalidated by any change of them. YAML isn't
+        parsed and the files aren't even read when the cache is warm. Cache is plain JSON, nothing
+        found in repository is unpickled.
+        """
+        if profile is not None and (not profile or os.sep in profile or '..' in profile or
+                                    (os.altsep and os.altsep in profile)):
+            raise ValueError('Invalid profile name "{}"'.format(profile))
+        cache_name = CONFIG_CACHE_NAME if profile is None else '{}.{}'.format(CONFIG_CACHE_NAME, profile)
+        cache_path = os.path.join(os.path.dirname(path), cache_name)
+        try:
+            with timed('config.cache'), open(cache_path) as fd:
+                cache = json.load(fd)
+            cached_sources = cache['sources']
+            if cache['version'] == CONFIG_CACHE_VERSION and cached_sources[0][0] == os.path.abspath(path):
+                with timed('config.read'):
+                    current = all(file_unchanged(source) for source in cached_sources)
+                if current:
+                    logger.debug('Using cached configuration from "%s"', cache_path)
+                    return cls._from_data(cache['config'])
+        except Exception as e:
+            logger.debug('Configuration cache "%s" is not used: %s', cache_path, e)
+        with timed('config.parse'):
+            resolver = ConfigResolver()
+            resolver.add_file(path)
+            if profile is not None:
+                resolver.add_profile(profile)
+            config = resolver.config()
+        key = resolver.sources
+        config.sources = [source[0] for source in key]
+        config.write_names_index(os.path.join(os.path.dirname(path), NAMES_INDEX_NAME))
+        try:
+            with timed('config.cache'), atomic_write(cache_path) as fd:
+                json.dump({'version': CONFIG_CACHE_VERSION, 'sources': key, 'config': config._as_data()}, fd)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            # e.g. variables with values not representable in JSON
+            logger.debug('Configuration cache "%s" is not saved: %s', cache_path, e)
+        return config
+
+    def _as_data(self):
+        """Plain data of resolved configuration stored by load()."""
+        return {
+            'dotfiles': [vars(df) for df in self.dotfiles],
+            'variables': self.variables,
+            'hosts': self.hosts,
+            'store': self.store,
+            'hooks': self.hooks,
+            'sources': self.sources
+        }
+
+    @classmethod
+    def _from_data(cls, data):
+        config = cls([DotFile(**df) for df in data['dotfiles']], data['variables'], data['hosts'],
+                     store=data['store'], hooks=data['hooks'])
+        config.sources = data['sources']
+        return config
 
     def to_yaml(self, stream=None):
         return yaml.serialize(self._as_yaml_node(), stream)
 
+    def write_names_index(self, path):
+        try:
+            with atomic_write(path) as fd:
+                fd.write(''.join(df.name + '\n' for df in self.dotfiles))
+        except (IOError, OSError) as e:
+            logger.debug('Names index "%s" is not saved: %s', path, e)
+
     def __eq__(self, other):
         # exact order of dotfiles should not matter
         return set(self.dotfiles) == set(other.dotfiles)
 
 
-def clone_git_repo(url):
-    def check_call(*args):
-        subprocess.check_call(args)
+class ConfigResolver(object):
+    """Merges layers of configuration into flat Config.
+
+    Layers are applied in order: included files (recursively), the configuration file itself,
+    then the profile with profiles it extends and their includes. Layer can define 'dotfiles',
+    'variables', 'hosts', 'store', 'include' and 'exclude' (names of dotfiles to drop). Dotfile of a later
+    layer overrides fields (e.g. only 'target' or 'action') of the earlier one with the same name.
+    Global 'pre_install' and 'post_install' hooks of all the layers are run in order of the layers.
+    Profiles are defined in 'profiles' mapping of any of the files and can 'extends' other ones.
+    """
+
+    def __init__(self):
+        self.sources = []
+        self.dotfiles = OrderedDict()
+        self.variables = {}
+        self.hosts = {}
+        self.store = False
+        self.hooks = {}
+        self.profiles = {}
+
+    def add_file(self, path, stack=()):
+        path = os.path.abspath(path)
+        if path in stack:
+            raise ValueError('Configuration file "{}" includes itself'.format(path))
+        key, content = file_key(path)
+        self.sources.append(key)
+        data = yaml.load(content, Loader=yaml_loader()) or {}
+        base_dir = os.path.dirname(path)
+        self.add_layer(data, base_dir, stack + (path,))
+        for name, profile in (data.get('profiles') or {}).items():
+            self.profiles[name] = (profile or {}, base_dir)
+
+    def add_layer(self, data, base_dir, stack=()):
+        for include in as_list(data.get('include')):
+            self.add_file(os.path.join(base_dir, os.path.expanduser(include)), stack)
+        for df in data.get('dotfiles') or []:
+            self.dotfiles[df['name']] = dict(self.dotfiles.get(df['name'], {}), **df)
+        for name in as_list(data.get('exclude')):
+            self.dotfiles.pop(name, None)
+        self.variables = merge_variables(self.variables, data.get('variables') or {})
+        self.hosts = merge_variables(self.hosts, data.get('hosts') or {})
+        if 'store' in data:
+            self.store = bool(data['store'])
+        for key in HOOK_STAGES:
+            if data.get(key):
+                self.hooks[key] = self.hooks.get(key, []) + as_list(data[key])
+
+    def add_profile(self, name, stack=()):
+        if name not in self.profiles:
+            raise ValueError('Unknown profile "{}"'.format(name))
+        if name in stack:
+            raise ValueError('Profile "{}" extends itself'.format(name))
+        profile, base_dir = self.profiles[name]
+        for parent in as_list(profile.get('extends')):
+            self.add_profile(parent, stack + (name,))
+        self.add_layer(profile, base_dir)
+
+    def config(self):
+        return Config([DotFile(**df) for df in self.dotfiles.values()], self.variables, self.hosts,
+                      store=self.store, hooks=self.hooks)
+
+
+class ConfigFile(object):
+    """Single configuration file edited in place by init and grab.
+
+    File is kept as composed YAML nodes rather than Config, so that existing entries are written back
+    exactly as they are: dotfiles overriding only some fields of included ones stay partial and
+    omitted fields aren't filled with defaults. Comments are lost on rewrite though.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        root = None
+        if os.path.exists(path):
+            with open(path, 'rb') as fd:
+                root = yaml.compose(fd.read(), Loader=yaml_loader())
+        self.root = root if isinstance(root, yaml.MappingNode) else yaml_map([])
+
+    def __str__(self):
+        return '<ConfigFile: path={!r}>'.format(self.path)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def _get(self, key):
+        for key_node, value_node in self.root.value:
+            if key_node.value == key:
+                return value_node
+        return None
+
+    def _set(self, key, node):
+        for i, (key_node, _) in enumerate(self.root.value):
+            if key_node.value == key:
+                self.root.value[i] = (key_node, node)
+                return
+        self.root.value.append((yaml_scalar(key), node))
+
+    def _entries(self):
+        node = self._get('dotfiles')
+        if not isinstance(node, yaml.SequenceNode):
+            node = yaml_seq([])
+            self._set('dotfiles', node)
+        return node
+
+    @staticmethod
+    def _entry_name(node):
+        for key_node, value_node in node.value if isinstance(node, yaml.MappingNode) else ():
+            if key_node.value == 'name':
+                return value_node.value
+        return None
+
+    @property
+    def names(self):
+        """Names of dotfiles listed in the file."""
+        return [self._entry_name(node) for node in self._entries().value]
+
+    @property
+    def excludes(self):
+        node = self._get('exclude')
+        if isinstance(node, yaml.SequenceNode):
+            return [elem.value for elem in node.value]
+        return [] if node is None or node.tag.endswith(':null') else [node.value]
+
+    @property
+    def store(self):
+        node = self._get('store')
+        return node is not None and yaml.load(yaml.serialize(node), Loader=yaml_loader()) is True
+
+    @store.setter
+    def store(self, value):
+        self._set('store', yaml_node(bool(value)))
+
+    def add_dotfiles(self, dotfiles):
+        """Append dotfiles replacing entries with the same names, grabbed names are no longer excluded."""
+        names = set(df.name for df in dotfiles)
+        entries = self._entries()
+        entries.value = [node for node in entries.value if self._entry_name(node) not in names]
+        entries.value.extend(df._as_yaml_node() for df in dotfiles)
+        # 'dotfiles: []' stays in flow style otherwise
+        entries.flow_style = False
+        excludes = self.excludes
+        if names.intersection(excludes):
+            self._set('exclude', yaml_node([name for name in excludes if name not in names]))
+
+    def write(self):
+        with atomic_write(self.path) as fd:
+            yaml.serialize(self.root, fd, Dumper=yaml_dumper())
+
+
+class Manifest(object):
+    """Represents content of 'manifest.json' (state of dotfiles left by previous installations).
+
+    Every entry is keyed by name of the dotfile and remembers how it was installed: absolute path
+    of the target, action, source path, lstat of the target and, for copied and rendered dotfiles,
+    signature and content digest of the source. Rendered templates also keep digest of variables,
+    copied directories keep stat signature of the whole target tree.
+    """
+
+    def __init__(self, entries=None, hash_cache=None):
+        self.entries = {} if entries is None else entries
+        self.hash_cache = hash_cache
+        self.modified = False
+
+    def __str__(self):
+        return '<Manifest: #entries={}>'.format(len(self.entries))
+
+    def __repr__(self):
+        return self.__str__()
+
+    @classmethod
+    def load(cls, path, hash_cache=None):
+        """Load manifest, hash_cache is used to compute digests of copied dotfiles."""
+        try:
+            with open(path) as fd:
+                data = json.load(fd)
+        except (IOError, OSError, ValueError) as e:
+            logger.debug('Manifest "%s" is not loaded: %s', path, e)
+            return cls(hash_cache=hash_cache)
+        if data.get('version') != MANIFEST_VERSION:
+            logger.debug('Manifest "%s" has unsupported version', path)
+            return cls(hash_cache=hash_cache)
+        return cls(data.get('entries', {}), hash_cache)
+
+    def save(self, path):
+        with atomic_write(path) as fd:
+            json.dump({'version': MANIFEST_VERSION, 'entries': self.entries}, fd, indent=1, sort_keys=True)
+        self.modified = False
+
+    def target_unchanged(self, dotfile, src, dst, st=None):
+        """Check that target wasn't touched since previous installation of dotfile.
+
+        st is lstat result of the target if it's already known.
+        """
+        entry = self.entries.get(dotfile.name)
+        if entry is None or entry['target'] != dst or entry['action'] != dotfile.action or entry['src'] != src:
+            return False
+        if st is None:
+            try:
+                st = os.lstat(dst)
+            except OSError:
+                return False
+        if [st.st_ino, st.st_size, st.st_mtime_ns] != entry['stat']:
+            return False
+        if dotfile.action == 'copy' and stat.S_ISDIR(st.st_mode):
+            # files changed in place don't touch stat of the directory itself
+            try:
+                return source_signature(dst) == entry.get('tree')
+            except OSError:
+                return False
+        return True
+
+    def is_current(self, dotfile, src, dst, st=None, variables_key=None):
+        """Check that dotfile was installed by previous run and left untouched since then.
+
+        It's a single lstat of the target for 'symlink' and 'include' actions (none if st, lstat
+        result of the target, is given). Copied and rendered dotfiles additionally compare stat
+        signature of the source and, if it differs, its content. Templates are rendered again
+        only if variables_key, the digest of their variables, has changed as well.
+        """
+        if not self.target_unchanged(dotfile, src, dst, st):
+            return False
+        entry = self.entries[dotfile.name]
+        if dotfile.action == 'template' and entry.get('variables') != variables_key:
+            return False
+        if dotfile.action in ('copy', 'template'):
+            try:
+                signature = source_signature(src)
+            except OSError:
+                # sources of dotfiles installed from bundle aren't extracted, there is nothing to update
+                # target from, while missing source of ordinary dotfile has to be reported
+                return self.from_bundle(dotfile)
+            if signature != entry['signature']:
+                if content_digest(src, self.hash_cache) != entry['digest']:
+                    return False
+                # source was touched but not changed
+                entry['signature'] = signature
+                self.modified = True
+        return True
+
+    def record(self, dotfile, src, dst, variables_key=None, digest=None):
+        """Remember installed dotfile, digest of the source is computed unless it's given."""
+        st = os.lstat(dst)
+        entry = {
+            'target': dst,
+            'action': dotfile.action,
+            'src': src,
+            'stat': [st.st_ino, st.st_size, st.st_mtime_ns]
+        }
+        if dotfile.action in ('copy', 'template') and digest is not None:
+            # source isn't examined, its content is compared with digest on the next run
+            entry['signature'] = None
+            entry['digest'] = digest
+            entry['bundled'] = True
+        elif dotfile.action in ('copy', 'template'):
+            entry['signature'] = source_signature(src)
+            entry['digest'] = content_digest(src, self.hash_cache)
+        if dotfile.action == 'template':
+            entry['variables'] = variables_key
+        if dotfile.action == 'copy' and stat.S_ISDIR(st.st_mode):
+            entry['tree'] = source_signature(dst)
+        self.entries[dotfile.name] = entry
+        self.modified = True
+
+    def from_bundle(self, dotfile):
+        """Check that copied or rendered dotfile was installed from bundle without its source."""
+        entry = self.entries.get(dotfile.name)
+        return entry is not None and entry.get('bundled', False)
+
+    def owns(self, dotfile, dst):
+        """Check that target was created by previous installation of the same dotfile."""
+        entry = self.entries.get(dotfile.name)
+        return entry is not None and entry['target'] == dst and entry['action'] == dotfile.action
+
+    def refresh(self, dst):
+        """Update lstat of 'include' entries of target after lines were appended to it."""
+        entries = [entry for entry in self.entries.values()
+                   if entry['target'] == dst and entry['action'] == 'include']
+        if entries:
+            st = os.lstat(dst)
+            for entry in entries:
+                entry['stat'] = [st.st_ino, st.st_size, st.st_mtime_ns]
+            self.modified = True
+
+    def forget(self, name):
+        if self.entries.pop(name, None) is not None:
+            self.modified = True
+
+    def prune(self, names):
+        """Drop entries of dotfiles not mentioned in configuration anymore."""
+        for name in list(self.entries):
+            if name not in names:
+                self.forget(name)
+
+
+def mirror_path(cache_dir, url):
+    """Location of bare mirror of git repository in the local cache."""
+    name = re.sub(r'[^\w.-]+', '_', url).strip('_')
+    return os.path.join(cache_dir, '{}-{}.git'.format(name, hashlib.sha1(url.encode('utf-8')).hexdigest()[:8]))
+
+
+def update_mirror(cache_dir, url):
+    """Create or refresh local bare mirror of git repository and return its path.
+
+    Mirror is updated under exclusive lock of its '.lock' file, clones from it should hold shared
+    one, so that many clones sharing the cache (e.g. containers on one host) never see half-created
+    or half-updated mirror. New mirror is cloned into temporary directory renamed into place.
+    """
+    path = mirror_path(cache_dir, url)
+    os.makedirs(cache_dir, exist_ok=True)
+    with file_lock(path + '.lock'):
+        if os.path.isdir(path):
+            with timed('git remote', args=url):
+                subprocess.check_call(['git', '--git-dir', path, 'remote', 'update', '--prune'])
+            return path
+        temp_path = tempfile.mkdtemp(prefix='.' + os.path.basename(path) + '.', dir=cache_dir)
+        try:
+            os.chmod(temp_path, 0o777 & ~current_umask())
+            with timed('git clone', args=url):
+                subprocess.check_call(['git', 'clone', '--mirror', url, temp_path])
+            os.rename(temp_path, path)
+        except BaseException:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
+    return path
+
+
+def clone_git_repo(url, depth=None, filter_spec=None, jobs=None, mirror=None, repo='.'):
+    """Clone dotfiles repository with its submodules into 'dotfiles' directory of pot repository.
+
+    depth       - create shallow clone with history truncated to this number of commits
+    filter_spec - partial clone filter, e.g. 'blob:none'
+    jobs        - number of submodules fetched in parallel
+    mirror      - directory of local mirrors cache, objects of existing mirror are copied instead of
+                  being fetched, clone doesn't depend on the mirror afterwards. Top-level submodules
+                  are cloned through mirrors of their own URLs.
+    repo        - pot repository
+    """
+    dotfiles_dir = os.path.join(repo, 'dotfiles')
+
+    def check_call(*args, **kwargs):
+        with timed('git ' + args[1], args=' '.join(args)):
+            subprocess.check_call(args, **kwargs)
+
+    def check_call_with_mirror(url, args, positional, **kwargs):
+        mirror_repo = os.path.abspath(update_mirror(mirror, url))
+        with file_lock(mirror_repo + '.lock', exclusive=False):
+            # borrowed objects would be lost with pruned or deleted mirror
+            check_call(*(args + ['--reference', mirror_repo, '--dissociate'] + positional), **kwargs)
+
+    options = []
+    if depth:
+        options += ['--depth', str(depth)]
+    if filter_spec:
+        options += ['--filter', filter_spec]
+    if mirror:
+        check_call_with_mirror(url, ['git', 'clone'] + options, [url, dotfiles_dir])
+    else:
+        check_call('git', 'clone', *(options + [url, dotfiles_dir]))
+    if os.path.exists(os.path.join(dotfiles_dir, '.gitmodules')):
+        options = []
+        if depth:
+            options += ['--recommend-shallow']
+        if filter_spec:
+            options += ['--filter', filter_spec]
+        if mirror:
+            check_call('git', 'submodule', 'init', cwd=dotfiles_dir)
+            try:
+                paths = git_output('config', '-f', '.gitmodules', '-z', '--get-regexp', r'^submodule\..*\.path$',
+                                   cwd=dotfiles_dir)
+            except subprocess.CalledProcessError:
+                # no submodules are defined
+                paths = ''
+            submodules = []
+            for line in filter(None, paths.split('\0')):
+                key, path = line.split('\n', 1)
+                # URL is resolved by 'submodule init' if it's relative to the superproject
+                submodules.append((path, git_output('config', key[:-len('.path')] + '.url',
+                                                    cwd=dotfiles_dir).strip()))
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(jobs or 1) as pool:
+                for future in [pool.submit(check_call_with_mirror, submodule_url, ['git', 'submodule', 'update'] +
+                                           options, ['--', path], cwd=dotfiles_dir)
+                               for path, submodule_url in submodules]:
+                    future.result()
+        # nested submodules and ones not cloned through mirrors
+        options += ['--init', '--recursive']
+        if jobs:
+            options += ['--jobs', str(jobs)]
+        check_call('git', 'submodule', 'update', *options, cwd=dotfiles_dir)
+
+
+def git_output(*args, **kwargs):
+    with timed('git ' + args[0], args=' '.join(args)):
+        return subprocess.check_output(('git',) + args, **kwargs).decode('utf-8')
+
+
+def pull_git_repo(repo='.'):
+    """Pull dotfiles repository with its submodules and return paths changed by the pull."""
+    dotfiles_dir = os.path.join(repo, 'dotfiles')
+    old_head = git_output('rev-parse', 'HEAD', cwd=dotfiles_dir).strip()
+    with timed('git pull'):
+        subprocess.check_call(['git', 'pull'], cwd=dotfiles_dir)
+    if os.path.exists(os.path.join(dotfiles_dir, '.gitmodules')):
+        with timed('git submodule'):
+            subprocess.check_call(['git', 'submodule', 'update', '--init', '--recursive'], cwd=dotfiles_dir)
+    new_head = git_output('rev-parse', 'HEAD', cwd=dotfiles_dir).strip()
+    if old_head == new_head:
+        return []
+    # renamed source is reported by both its old and new paths, so dotfile installed from the old one isn't missed
+    return git_output('diff', '--name-only', '--no-renames', '--no-ext-diff', old_head, new_head,
+                      cwd=dotfiles_dir).splitlines()
+
+
+def affected_dotfiles(dotfiles, paths):
+    """Find dotfiles whose sources contain any of the paths (relative to 'dotfiles' directory)."""
+    by_name = {}
+    for dotfile in dotfiles:
+        by_name[dotfile.name] = dotfile
+    affected = set()
+    for path in paths:
+        # check every leading part of the path: changes in '.vim/colors/x.vim' affect '.vim'
+        prefix = None
+        for part in path.split('/'):
+            prefix = part if prefix is None else prefix + '/' + part
+            if prefix in by_name:
+                affected.add(prefix)
+    return [df for df in dotfiles if df.name in affected]
+
+
+class Hook(object):
+    """Shell command run around installation of dotfiles.
+
+    stage   - 'pre_install' or 'post_install'
+    command - command line run by /bin/sh in dotfiles directory
+    timeout - seconds after which the command is killed
+    dotfile - dotfile the hook belongs to or None for global hooks
+    error   - why the hook failed, None if it succeeded
+    output  - captured stdout and stderr of the command
+    """
+
+    def __init__(self, stage, command, timeout=HOOK_TIMEOUT, dotfile=None):
+        self.stage = stage
+        self.command = command
+        self.timeout = timeout
+        self.dotfile = dotfile
+        self.error = None
+        self.output = ''
+
+    def __str__(self):
+        return '<Hook: {} {!r}>'.format(self.stage, self.command)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def parse_hooks(stage, value, dotfile=None):
+    """Make hooks of the stage from configuration.
+
+    Every hook is either a command or a mapping with command in 'run' and optional 'timeout'.
+    Single hook can be given instead of a list.
+    """
+    hooks = []
+    for item in as_list(value):
+        if not isinstance(item, dict):
+            item = {'run': item}
+        if not item.get('run'):
+            raise ValueError('Hook {!r} has no command to run'.format(item))
+        hooks.append(Hook(stage, str(item['run']), float(item.get('timeout', HOOK_TIMEOUT)), dotfile))
+    return hooks
+
+
+class HookError(Exception):
+    """Raised when post_install hooks fail, plan is the installation plan applied before them."""
+
+    def __init__(self, message, plan):
+        super(HookError, self).__init__(message)
+        self.plan = plan
+
+
+class HookRunner(object):
+    """Runs hooks of dotfiles changed by installation plan as asyncio subprocesses.
+
+    Global 'pre_install' hooks are run one by one, then hooks of the dotfiles are run in parallel,
+    at most jobs commands at once, though hooks of the same dotfile still run in order of
+    configuration. 'post_install' hooks go the other way around, global ones are run last.
+    Hooks aren't run at all if nothing is going to be changed.
+    """
+
+    # kinds of operations which change installed dotfiles
+    changes = frozenset(['link', 'sync', 'include', 'render'])
+
+    def __init__(self, config, repo, home=None, jobs=None):
+        self.hooks = config.hooks
+        self.cwd = os.path.join(repo, 'dotfiles')
+        # POT_HOME is left as it is, it's the location of global repository
+        self.env = dict(os.environ, POT_REPO=repo,
+                        POT_TARGET_HOME=os.path.abspath(os.path.expanduser(home or '~')))
+        self.jobs = jobs or HOOK_JOBS
+
+    def pre_install(self, plan):
+        """Run hooks before applying the plan, return the plan with failed dotfiles replaced by 'fail'."""
+        changed = [op for op in plan if op.kind in self.changes]
+        if not changed:
+            return plan
+        failed = self._run('pre_install', changed, global_first=True)
+        if failed is None:
+            return [self._fail(op, 'global pre_install hook failed') if op.kind in self.changes else op
+                    for op in plan]
+        return [self._fail(op, 'pre_install hook of "{}" failed'.format(op.dotfile.name))
+                if op.dotfile is not None and op.dotfile.name in failed else op for op in plan]
+
+    def post_install(self, plan):
+        """Run hooks after the plan was applied, raise HookError if some of them failed.
+
+        Only dotfiles which targets were actually changed are taken into account.
+        """
+        changed = [op for op in plan if op.kind in self.changes and op.changed]
+        if not changed:
+            return
+        failed = self._run('post_install', changed, global_first=False)
+        if failed is None:
+            raise HookError('Global post_install hook failed', plan)
+        if failed:
+            raise HookError('post_install hooks of {} failed'.format(
+                ', '.join('"{}"'.format(name) for name in sorted(failed))), plan)
+
+    @staticmethod
+    def _fail(operation, error):
+        return Operation('fail', operation.dotfile, operation.src, operation.dst, error=error)
+
+    def _run(self, stage, operations, global_first):
+        """Run hooks of the stage, return names of the dotfiles with failed hooks or None if global ones failed."""
+        global_hooks = parse_hooks(stage, self.hooks.get(stage))
+        chains = [(op, parse_hooks(stage, getattr(op.dotfile, stage), op.dotfile)) for op in operations]
+        chains = [(op, hooks) for op, hooks in chains if hooks]
+        env = dict(self.env, POT_STAGE=stage, POT_DOTFILES='\n'.join(op.dotfile.name for op in operations))
+
+        async def run_all():
+            semaphore = asyncio.Semaphore(self.jobs)
+            if global_first and not await self._run_chain(global_hooks, semaphore, env):
+                return None
+            results = await asyncio.gather(*[self._run_chain(hooks, semaphore, self._dotfile_env(env, op))
+                                             for op, hooks in chains])
+            failed = set(op.dotfile.name for (op, _), success in zip(chains, results) if not success)
+            if not global_first and not await self._run_chain(global_hooks, semaphore, env):
+                return None
+            return failed
+
+        if not global_hooks and not chains:
+            return set()
+        with timed('hooks.' + stage):
+            return asyncio.run(run_all())
+
+    @staticmethod
+    def _dotfile_env(env, operation):
+        return dict(env, POT_DOTFILE=operation.dotfile.name, POT_ACTION=operation.dotfile.action,
+                    POT_SOURCE=operation.src, POT_TARGET=operation.dst)
+
+    async def _run_chain(self, hooks, semaphore, env):
+        """Run hooks one by one until one of them fails, return whether all of them succeeded."""
+        for hook in hooks:
+            async with semaphore:
+                await self._run_hook(hook, env)
+            if hook.error is not None:
+                return False
+        return True
+
+    async def _run_hook(self, hook, env):
+        name = None if hook.dotfile is None else hook.dotfile.name
+        logger.info('Running %s hook "%s"%s', hook.stage, hook.command, '' if name is None else ' of ' + name)
+        start = time.perf_counter()
+        try:
+            # own session allows to kill commands started by the hook along with it
+            process = await asyncio.create_subprocess_shell(
+                hook.command, cwd=self.cwd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, start_new_session=True)
+        except OSError as e:
+            hook.error = str(e)
+        else:
+            reader = asyncio.ensure_future(process.stdout.read())
+            try:
+                await asyncio.wait_for(process.wait(), hook.timeout)
+            except asyncio.TimeoutError:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                await process.wait()
+                hook.error = 'timed out after {:g} seconds'.format(hook.timeout)
+            else:
+                if process.returncode != 0:
+                    hook.error = 'exited with status {}'.format(process.returncode)
+            hook.output = (await reader).decode('utf-8', 'replace')
+        if hook.output:
+            logger.log(logging.DEBUG if hook.error is None else logging.ERROR, '%s', hook.output.rstrip('\n'))
+        if hook.error is not None:
+            logger.error('Hook "%s" %s', hook.command, hook.error)
+        if events is not None:
+            events.action('hook', None, hook.stage, 'ok' if hook.error is None else 'failed', start,
+                          dotfile=name, command=hook.command, error=hook.error, output=hook.output)
+
+
+class PotRepo(object):
+    """Session of work with pot repository, intended for embedding pot into other programs.
+
+    It holds the path of the repository and its parsed configuration. Methods take explicit
+    paths and never change current directory, so one session can be shared by threads of
+    a pool or an asyncio executor. Installations into the same home directory are serialized.
+    Configuration is resolved for the profile if it's given.
+    """
+
+    def __init__(self, path, config=None, profile=None):
+        self.path = os.path.abspath(path)
+        self.config_path = os.path.join(self.path, 'config.yaml')
+        self.dotfiles_dir = os.path.join(self.path, 'dotfiles')
+        self.profile = profile
+        self.hash_cache = HashCache(os.path.join(self.path, HASH_CACHE_NAME))
+        self._config = config
+        self._store = None
+        self._lock = threading.Lock()
+        self._home_locks = {}
+
+    def __str__(self):
+        return '<PotRepo: {}>'.format(self.path)
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def config(self):
+        with self._lock:
+            if self._config is None:
+                self._config = Config.load(self.config_path, self.profile)
+            return self._config
+
+    def reload(self):
+        """Forget parsed configuration, it will be read again on the next access."""
+        with self._lock:
+            self._config = None
+
+    @property
+    def store(self):
+        """Object store used by the repository or None if it's disabled in configuration."""
+        if not self.config.store:
+            return None
+        with self._lock:
+            if self._store is None:
+                self._store = ObjectStore.for_repo(self.path)
+            return self._store
+
+    def _home_lock(self, key):
+        with self._lock:
+            return self._home_locks.setdefault(key, threading.Lock())
+
+    def lock(self, exclusive=False):
+        """Advisory lock of the repository held by other pot processes and sessions as well.
+
+        Readers of configuration and dotfiles share it, commands changing them lock it exclusively.
+        """
+        if exclusive and not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        return file_lock(os.path.join(self.path, LOCK_NAME), exclusive)
+
+    def _plan(self, names, force, full, home):
+        config = self.config
+        names_to_dotfiles = {df.name: df for df in config.dotfiles}
+        if names is None:
+            names = [df.name for df in config.dotfiles]
+        with timed('manifest.load'):
+            manifest = Manifest.load(manifest_path(self.path, home), self.hash_cache)
+        manifest.prune(names_to_dotfiles)
+        with timed('install.plan'):
+            plan = plan_install(names, names_to_dotfiles, manifest, force, full, repo=self.path, home=home,
+                                variables=config.template_variables(home))
+        return plan, manifest
+
+    def plan(self, names=None, force=False, full=False, home=None):
+        """Return installation plan without applying it."""
+        with self.lock():
+            return self._plan(names, force, full, home)[0]
+
+    def install(self, names=None, force=False, full=False, home=None, jobs=1, hook_jobs=None):
+        """Install dotfiles into home (user's home directory by default) and return applied plan.
+
+        Installations into different homes can run in parallel, each one locks its manifest.
+        Hooks of changed dotfiles are run around installation, at most hook_jobs at once.
+        Dotfiles which pre_install hooks failed are left untouched and reported as failed,
+        failure of post_install hooks raises HookError once the plan is applied.
+        """
+        path = manifest_path(self.path, home)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with self._home_lock(path), self.lock(), manifest_lock(self.path, home):
+            plan, manifest = self._plan(names, force, full, home)
+            hooks = HookRunner(self.config, self.path, home, hook_jobs)
+            plan = hooks.pre_install(plan)
+            try:
+                apply_plan(plan, manifest, jobs, manifest_path=path, store=self.store)
+            finally:
+                self.hash_cache.save()
+            hooks.post_install(plan)
+        return plan
+
+    def status(self, names=None, home=None):
+        """Return (dotfile, target, state) triples, see dotfile_status() for possible states."""
+        with self.lock():
+            config = self.config
+            names_to_dotfiles = {df.name: df for df in config.dotfiles}
+            if names is None:
+                names = [df.name for df in config.dotfiles]
+            dotfiles = []
+            for name in names:
+                if name not in names_to_dotfiles:
+                    logger.error('No such file %s. Check configuration file.', name)
+                    continue
+                dotfiles.append(names_to_dotfiles[name])
+            manifest = Manifest.load(manifest_path(self.path, home))
+            targets = [expand_target(df.target, home, self.path) for df in dotfiles]
+            entries = scan_targets(targets)
+            result = []
+            for dotfile, dst in zip(dotfiles, targets):
+                src = os.path.abspath(os.path.join(self.dotfiles_dir, dotfile.name))
+                result.append((dotfile, dst, dotfile_status(dotfile, src, dst, entries[dst], manifest)))
+            return result
+
+    def bundle(self, output):
+        """Pack configuration and dotfiles into single compressed archive for install_bundle().
+
+        The first member is an index with resolved dotfiles and digests of copied and template
+        ones, followed by flat config.yaml and sources of the dotfiles in the same order.
+        Returns False if some of the dotfiles are missing.
+        """
+        with self.lock():
+            config = self.config
+            dotfiles = []
+            success = True
+            for dotfile in config.dotfiles:
+                src = os.path.join(self.dotfiles_dir, dotfile.name)
+                if not os.path.lexists(src):
+                    logger.error('Dotfile "%s" doesn\'t exists', src)
+                    success = False
+                    continue
+                entry = {'name': dotfile.name, 'target': dotfile.target, 'action': dotfile.action}
+                if dotfile.action in ('copy', 'template'):
+                    entry['digest'] = content_digest(src, self.hash_cache)
+                dotfiles.append(entry)
+            self.hash_cache.save()
+            index = {'version': BUNDLE_VERSION, 'profile': self.profile, 'dotfiles': dotfiles}
+            config_stream = io.StringIO()
+            Config(config.dotfiles, config.variables, config.hosts, store=config.store,
+                   hooks=config.hooks).write(config_stream)
+
+            def regular_member(info):
+                # files sharing inode (e.g. linked to object store) are stored in full, so every member
+                # can be written on its own while bundle is streamed
+                if info.islnk():
+                    info.type = tarfile.REGTYPE
+                    info.size = os.lstat(os.path.join(self.path, info.name)).st_size
+                return info
+
+            with report_action('Bundling {} dotfiles into "{}"', len(dotfiles), output), timed('bundle.write'):
+                with atomic_write(output, 'wb') as fd:
+                    with tarfile.open(fileobj=fd, mode='w|' + bundle_compression(output)) as tar:
+                        add_bundle_member(tar, BUNDLE_INDEX_NAME, json.dumps(index).encode('utf-8'))
+                        add_bundle_member(tar, 'config.yaml', config_stream.getvalue().encode('utf-8'))
+                        for entry in dotfiles:
+                            tar.add(os.path.join(self.dotfiles_dir, entry['name']), 'dotfiles/' + entry['name'],
+                                    filter=regular_member)
+            return success
+
+    def install_bundle(self, path, force=False, home=None):
+        """Install dotfiles from archive created by bundle() reading it once, sequentially.
+
+        Copied and template dotfiles are written straight to their targets, only sources of
+        symlinked and included ones are extracted into the repository. Manifest is filled
+        from the index of the bundle. Returns False if some of the dotfiles weren't installed.
+        Hooks of the bundled configuration aren't run.
+        """
+        with self.lock(exclusive=True):
+            if os.path.exists(self.config_path) and not force:
+                raise ValueError('Configuration file "{}" already exists'.format(self.config_path))
+            success = True
+            with timed('bundle.read'), tarfile.open(path, 'r|*') as tar:
+                members = iter(tar)
+                member = next(members, None)
+                if member is None or member.name != BUNDLE_INDEX_NAME:
+                    raise ValueError('"{}" is not a pot bundle'.format(path))
+                index = json.loads(tar.extractfile(member).read().decode('utf-8'))
+                if index.get('version') != BUNDLE_VERSION:
+                    raise ValueError('Bundle "{}" has unsupported version'.format(path))
+                member = next(members, None)
+                if member is None or member.name != 'config.yaml':
+                    raise ValueError('"{}" is not a pot bundle'.format(path))
+                config_content = tar.extractfile(member).read()
+                with atomic_write(self.config_path, 'wb') as fd:
+                    fd.write(config_content)
+                with self._lock:
+                    self._config = Config.from_yaml(config_content)
+                entries = {entry['name']: entry for entry in index['dotfiles']}
+                variables = self._config.template_variables(home)
+                manifest_file = manifest_path(self.path, home)
+                if not os.path.isdir(os.path.dirname(manifest_file)):
+                    os.makedirs(os.path.dirname(manifest_file))
+                manifest = Manifest.load(manifest_file)
+                inclusions = Inclusions()
+                current = None
+                try:
+                    for member in members:
+                        if not member.name.startswith('dotfiles/'):
+                            logger.debug('Skipping unknown bundle member "%s"', member.name)
+                            continue
+                        relpath = member.name[len('dotfiles/'):]
+                        if current is None or not (relpath == current.name or relpath.startswith(current.name + '/')):
+                            if current is not None:
+                                success = current.finish() and success
+                            name = bundle_member_owner(relpath, entries)
+                            if name is None:
+                                logger.debug('Skipping unknown bundle member "%s"', member.name)
+                                current = None
+                                continue
+                            # members of every dotfile are consecutive, stray ones aren't extracted again
+                            current = BundledDotFile(self, entries.pop(name), manifest, inclusions, force, home,
+                                                     variables)
+                        current.extract(tar, member, relpath[len(current.name) + 1:])
+                    if current is not None:
+                        success = current.finish() and success
+                finally:
+                    try:
+                        inclusions.flush(manifest)
+                    finally:
+                        if manifest.modified:
+                            manifest.save(manifest_file)
+            return success
+
+    def grab(self, paths, force=False):
+        """Move files to repository, symlink them back and register them in configuration file.
+
+        Files with the same name (e.g. '~/.config/*/config') aren't grabbed at all, since they would
+        replace each other in repository. Returns False if some of the files weren't grabbed.
+        """
+        with self.lock(exclusive=True):
+            if isinstance(paths, str):
+                paths = [paths]
+            grabbed = []
+            success = True
+            paths = [os.path.abspath(path) for path in expand_patterns(paths)]
+            # the second of the files with the same name would replace the first one in repository
+            paths_by_name = OrderedDict()
+            for path in paths:
+                paths_by_name.setdefault(os.path.basename(path), []).append(path)
+            for name, same_name in paths_by_name.items():
+                if len(same_name) > 1:
+                    logger.error('Files %s would be grabbed as the same "%s"',
+                                 ', '.join('"{}"'.format(path) for path in same_name), name)
+                    success = False
+            for path in paths:
+                if len(paths_by_name[os.path.basename(path)]) > 1:
+                    continue
+                dotfile = grab_file(path, self.dotfiles_dir, force)
+                if dotfile is None:
+                    success = False
+                    continue
+                # grabbed files are symlinked back, so they aren't linked to the store
+                grabbed.append(dotfile)
+            if grabbed:
+                with self._lock:
+                    register_dotfiles(self.config_path, grabbed)
+                    self._config = None
+            return success
+
+
+def glob_regex(pattern):
+    """Translate gitignore(5) glob into regular expression, '*' doesn't match '/' unlike in fnmatch."""
+    result = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            result.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            result.append('.*')
+            i += 2
+            continue
+        c = pattern[i]
+        if c == '*':
+            result.append('[^/]*')
+        elif c == '?':
+            result.append('[^/]')
+        elif c == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            result.append('[' + chars.replace('\\', '\\\\') + ']')
+            i = end
+        elif c == '\\' and i + 1 < len(pattern):
+            i += 1
+            result.append(re.escape(pattern[i]))
+        else:
+            result.append(re.escape(c))
+        i += 1
+    return ''.join(result)
+
+
+class IgnoreRules(object):
+    """Patterns of ignore files compiled into regular expressions matched against paths relative to the root.
+
+    Supported subset of gitignore(5): comments, negation with '!', patterns anchored by a slash,
+    directory-only patterns with trailing slash, '*', '?', '**' and character classes. Patterns
+    are matched in reverse order, so the last matching one decides.
+    """
+
+    def __init__(self):
+        self.rules = []
+        self.digest = hashlib.sha1()
+
+    def add(self, pattern, base=''):
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith('#'):
+            return
+        self.digest.update('{}\0{}\n'.format(base, pattern).encode('utf-8'))
+        negated = pattern.startswith('!')
+        if negated:
+            pattern = pattern[1:]
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        anchored = '/' in pattern
+        regex = glob_regex(pattern.lstrip('/'))
+        if not anchored:
+            regex = '(?:.*/)?' + regex
+        if base:
+            regex = re.escape(base + '/') + regex
+        self.rules.append((re.compile(regex + '$'), negated, dir_only))
+
+    def load(self, path, base=''):
+        """Add patterns of ignore file at path applied to entries below base directory."""
+        try:
+            with open(path) as fd:
+                for line in fd:
+                    self.add(line, base)
+        except (IOError, OSError):
+            pass
+
+    def key(self):
+        """Digest of all the patterns added so far."""
+        return self.digest.hexdigest()
+
+    def ignored(self, relpath, is_dir=False):
+        for regex, negated, dir_only in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relpath):
+                return not negated
+        return False
+
+
+def discover_dotfiles(dotfiles_dir, cache=None):
+    """Yield DotFile of every hidden entry of dotfiles directory not excluded by ignore files.
+
+    Entries of directories shared by many programs (CONTAINER_DIRS, e.g. '.config') are yielded
+    instead of the directory itself, so 'dotfiles/.config/nvim' is installed as '~/.config/nvim'.
+    Every directory is listed with single os.scandir. Names found in a directory are saved in
+    cache mapping (if it's given) keyed by its modification time and ignore patterns in effect,
+    so unchanged directories aren't listed again.
+    """
+    rules = IgnoreRules()
+
+    def scan(relpath):
+        path = os.path.join(dotfiles_dir, relpath)
+        for name in IGNORE_FILES:
+            rules.load(os.path.join(path, name), relpath)
+        mtime = os.stat(path).st_mtime_ns
+        key = [mtime, rules.key()]
+        cached = None if cache is None else cache.get(relpath)
+        if cached is not None and cached[:2] == key:
+            children = cached[2]
+        else:
+            children = []
+            with timed('init.scan', path=relpath):
+                for entry in sorted(os.scandir(path), key=lambda e: e.name):
+                    if entry.name in INIT_SKIP_NAMES or (not relpath and not entry.name.startswith('.')):
+                        continue
+                    child = relpath + '/' + entry.name if relpath else entry.name
+                    is_dir = entry.is_dir()
+                    if not rules.ignored(child, is_dir):
+                        children.append([child, is_dir and child in CONTAINER_DIRS])
+            if cache is not None:
+                cache[relpath] = key + [children]
+        for child, container in children:
+            if container:
+                for dotfile in scan(child):
+                    yield dotfile
+            else:
+                yield DotFile(child)
+
+    return scan('')
+
+
+def bundle_compression(path):
+    """Choose compression of archive by extension of its name, gzip is used by default."""
+    for suffix, compression in (('.tar', ''), ('.xz', 'xz'), ('.bz2', 'bz2')):
+        if path.endswith(suffix):
+            return compression
+    return 'gz'
+
+
+def add_bundle_member(tar, name, content):
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(content))
+
+
+def bundle_member_owner(relpath, entries):
+    """Find name of the dotfile the member of bundle (path relative to 'dotfiles') belongs to."""
+    parts = relpath.split('/')
+    for i in range(1, len(parts) + 1):
+        name = '/'.join(parts[:i])
+        if name in entries:
+            return name
+    return None
 
-    check_call('git', 'clone', url, 'dotfiles')
-    with cd('dotfiles'):
-        if os.path.exists('.gitmodules'):
-            check_call('git', 'submodule', 'init')
-            check_call('git', 'submodule', 'update')
 
+def unsafe_member_path(root, relpath):
+    """Explain why path of bundle member relative to root can't be extracted, None if it can.
 
-def init(path, git_url=None):
+    Like tarfile's 'data' filter, absolute paths, '..' components and paths going through
+    symlinks (e.g. extracted by preceding members) are rejected.
+    """
+    if not relpath:
+        return None
+    parts = relpath.split('/')
+    if os.path.isabs(relpath) or '..' in parts:
+        return 'path "{}" leaves "{}"'.format(relpath, root)
+    path = root
+    for part in parts[:-1]:
+        path = os.path.join(path, part)
+        if os.path.islink(path):
+            return 'path "{}" goes through symlink "{}"'.format(relpath, path)
+    return None
+
+
+class BundledDotFile(object):
+    """Dotfile being installed from members of bundle streamed one by one.
+
+    Existing target is replaced only when the first member is written to it.
+    """
+
+    def __init__(self, repo, entry, manifest, inclusions, force, home, variables):
+        self.dotfile = DotFile(entry['name'], entry['target'], entry['action'])
+        self.name = self.dotfile.name
+        self.digest = entry.get('digest')
+        self.manifest = manifest
+        self.inclusions = inclusions
+        self.variables = variables
+        self.src = os.path.join(repo.dotfiles_dir, self.name)
+        self.dst = expand_target(self.dotfile.target, home, repo.path)
+        self.error = None
+        self.rejected = False
+        self.replace = False
+        self.start = time.perf_counter()
+        self.written = 0
+        manifest.forget(self.name)
+        action = self.dotfile.action
+        reason = unsafe_member_path(repo.dotfiles_dir, self.name)
+        if reason is not None:
+            self.reject(reason)
+        elif action not in ('symlink', 'copy', 'include', 'template'):
+            self.error = 'Unknown action "{}" of dotfile "{}"'.format(action, self.name)
+        elif action != 'include' and os.path.lexists(self.dst):
+            linked = action == 'symlink' and os.path.islink(self.dst) and os.readlink(self.dst) == self.src
+            if not (force or linked or broken_link(self.dst)):
+                self.error = 'File "{}" exists. Delete it manually or use force mode to override it'.format(self.dst)
+            elif not linked:
+                self.replace = True
+
+    def reject(self, reason):
+        """Stop extraction of the dotfile, nothing is written for it anymore."""
+        self.error = 'Bundled dotfile "{}" is rejected: {}'.format(self.name, reason)
+        self.rejected = True
+
+    def extract(self, tar, member, relpath):
+        """Write member of bundle, relpath is its path relative to the dotfile."""
+        action = self.dotfile.action
+        if self.rejected:
+            return
+        if action in ('symlink', 'include'):
+            # source is needed by the target
+            root = self.src
+        elif self.error is not None:
+            return
+        else:
+            root = self.dst
+        path = os.path.join(root, relpath) if relpath else root
+        reason = unsafe_member_path(root, relpath)
+        if reason is None and member.issym():
+            # links may point only inside of the dotfile, top-level one inside of its directory
+            base = root if relpath else os.path.dirname(root)
+            link = os.path.normpath(os.path.join(os.path.dirname(path), member.linkname))
+            if os.path.isabs(member.linkname) or not (link == base or link.startswith(base + os.sep)):
+                reason = 'symlink "{}" points outside of "{}"'.format(member.name, base)
+        if reason is not None:
+            self.reject(reason)
+            return
+        if self.replace and root == self.dst:
+            remove_path(self.dst)
+            self.replace = False
+        # data filter semantics: no set-id bits and no writes by group or others
+        mode = member.mode & 0o755
+        if root == self.dst and member.isreg():
+            # bundled sources may be read-only objects of the store, targets are edited in place
+            mode |= stat.S_IWUSR
+        if os.path.lexists(path) and not (member.isdir() and real_dir(path)):
+            remove_path(path)
+        if not member.isdir():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if member.isdir():
+            os.makedirs(path, exist_ok=True)
+            os.chmod(path, mode)
+        elif member.issym():
+            os.symlink(member.linkname, path)
+        elif member.isreg():
+            content = tar.extractfile(member)
+            if action == 'template':
+                rendered = render_template(content.read().decode('utf-8'), self.variables, self.name).encode('utf-8')
+                with atomic_write(path, 'wb') as fd:
+                    fd.write(rendered)
+            else:
+                with atomic_write(path, 'wb') as fd:
+                    shutil.copyfileobj(content, fd, 1 << 20)
+                os.utime(path, (member.mtime, member.mtime))
+            os.chmod(path, mode)
+            self.written += os.path.getsize(path)
+
+    def finish(self):
+        """Install dotfile once all its members are written. Returns False if it has failed."""
+        dotfile, src, dst = self.dotfile, self.src, self.dst
+        if events is not None:
+            events.action('install', dst, dotfile.action, 'ok' if self.error is None else 'failed', self.start,
+                          self.written, dotfile=self.name, bundle=True,
+                          **({} if self.error is None else {'error': self.error}))
+        if self.error is not None:
+            logger.error(self.error)
+            return False
+        if dotfile.action == 'symlink':
+            with report_action('Symlinking "{}" -> "{}"', dst, src):
+                if self.replace:
+                    remove_path(dst)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                if not os.path.islink(dst):
+                    os.symlink(src, dst)
+            self.manifest.record(dotfile, src, dst)
+        elif dotfile.action == 'include':
+            with report_action('Including "{}" in "{}"', src, dst):
+                self.inclusions.include(dotfile, src, dst, inclusion_line(src))
+        elif dotfile.action == 'copy':
+            logger.info('Copied "%s" as "%s"', self.name, dst)
+            self.manifest.record(dotfile, src, dst, digest=self.digest)
+        else:
+            logger.info('Rendered "%s" as "%s"', self.name, dst)
+            self.manifest.record(dotfile, src, dst, variables_digest(self.variables), self.digest)
+        return True
+
+
+def init(path, git_url=None, store=False, **clone_options):
+    """Create pot repository or add new dotfiles of existing one to its configuration file.
+
+    Configuration is streamed to the file while dotfiles are discovered. Entries of existing
+    configuration are kept as is, the file isn't touched at all if no new dotfiles are found.
+    Repository is locked exclusively meanwhile. Returns False if dotfiles repository can't be cloned.
+    """
     if not os.path.exists(path):
         os.makedirs(path)
-    if git_url:
-        with report_action('Cloning {}'.format(git_url), suppress=True):
-            with cd(path):
-                clone_git_repo(git_url)
-    with cd(path):
-        if not os.path.exists('dotfiles'):
-            os.mkdir('dotfiles')
-        hidden = os.path.join('dotfiles', '.**')
-        dotfiles = [DotFile(name=os.path.basename(f)) for f in glob.glob(hidden)]
-        config = Config(dotfiles)
-        with open('config.yaml', 'wb') as fd:
-            config.to_yaml(stream=fd)
-
-
-def install(names=None, force=False):
+    # concurrent init, install or grab would see half-populated repository
+    with PotRepo(path).lock(exclusive=True):
+        if git_url:
+            try:
+                with report_action('Cloning {}', git_url):
+                    clone_git_repo(git_url, repo=path, **clone_options)
+            except (OSError, subprocess.CalledProcessError):
+                # empty configuration would hide the failure
+                return False
+        dotfiles_dir = os.path.join(path, 'dotfiles')
+        if not os.path.exists(dotfiles_dir):
+            os.mkdir(dotfiles_dir)
+        cache_path = os.path.join(path, INIT_CACHE_NAME)
+        try:
+            with open(cache_path) as fd:
+                data = json.load(fd)
+            cache = data['directories'] if data.get('version') == INIT_CACHE_VERSION else {}
+        except (IOError, OSError, ValueError, KeyError) as e:
+            logger.debug('Init cache "%s" is not loaded: %s', cache_path, e)
+            cache = {}
+        config_path = os.path.join(path, 'config.yaml')
+        discovered = discover_dotfiles(dotfiles_dir, cache)
+        if os.path.exists(config_path):
+            config_file = ConfigFile(config_path)
+            known = set(config_file.names).union(config_file.excludes)
+            new_dotfiles = [df for df in discovered if df.name not in known]
+            if new_dotfiles or store and not config_file.store:
+                logger.info('Adding %d new dotfiles to "%s"', len(new_dotfiles), config_path)
+                config_file.add_dotfiles(new_dotfiles)
+                if store:
+                    config_file.store = True
+                with timed('config.write'):
+                    config_file.write()
+        else:
+            with timed('config.write'), atomic_write(config_path) as fd:
+                Config([], store=store).write(fd, discovered)
+        try:
+            with atomic_write(cache_path) as fd:
+                json.dump({'version': INIT_CACHE_VERSION, 'directories': cache}, fd)
+        except (IOError, OSError) as e:
+            logger.debug('Init cache "%s" is not saved: %s', cache_path, e)
+        if store:
+            dedupe_sources(PotRepo(path))
+
+
+def dedupe_sources(repo):
+    """Link large files of copied and rendered dotfiles of the repository to its object store."""
+    store = ObjectStore.for_repo(repo.path)
+    sources = [os.path.join(repo.dotfiles_dir, df.name) for df in repo.config.dotfiles
+               if df.action in ('copy', 'template')]
+    with report_action('Deduplicating sources of copied dotfiles through "{}"', store.path):
+        saved = sum(store.dedupe(src) for src in sources if os.path.lexists(src))
+        store.save()
+    logger.info('  %d bytes are shared with the store', saved)
+    return saved
+
+
+def install(names=None, force=False, jobs=1, full=False, dry_run=False, profile=None):
+    """Install dotfiles of repository in current directory. Returns False if some of them failed."""
     if not os.path.exists('config.yaml'):
         logger.error('Configuration file not found.')
+        return False
+    repo = PotRepo(os.getcwd(), profile=profile)
+    if dry_run:
+        for operation in repo.plan(names, force, full):
+            print_result(operation)
         return
-    with open(os.path.join(os.getcwd(), 'config.yaml')) as cfg:
-        config = Config.from_yaml(cfg)
-    names_to_dotfiles = {df.name: df for df in config.dotfiles}
-    if names is None:
-        names = names_to_dotfiles.keys()
+    # e.g. dotfiles which pre_install hooks failed, failed post_install hooks raise HookError
+    plan = repo.install(names, force, full, jobs=jobs)
+    return not any(op.kind == 'fail' for op in plan)
+
+
+def bundle(output=DEFAULT_BUNDLE_NAME, profile=None):
+    if not os.path.exists('config.yaml'):
+        logger.error('Configuration file not found.')
+        return False
+    return PotRepo(os.getcwd(), profile=profile).bundle(output)
+
+
+def install_bundle(path, force=False):
+    """Install dotfiles from bundle making current directory pot repository."""
+    return PotRepo(os.getcwd()).install_bundle(path, force)
+
+
+def manifest_path(repo, home=None):
+    """Location of the manifest of installation into home (user's home directory by default)."""
+    if home is None:
+        return os.path.join(repo, MANIFEST_NAME)
+    name = hashlib.sha1(os.path.abspath(home).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(repo, MANIFESTS_DIR, name + '.json')
+
+
+def manifest_lock(repo, home=None):
+    """Exclusive lock of the manifest, kept aside since manifests are replaced on every save."""
+    locks_dir = os.path.join(repo, LOCKS_DIR)
+    if not os.path.isdir(locks_dir):
+        os.makedirs(locks_dir)
+    return file_lock(os.path.join(locks_dir, os.path.basename(manifest_path(repo, home)) + '.lock'))
+
+
+def install_root(repo, config, home, names=None, force=False, full=False, collect_events=False):
+    """Install dotfiles into single home directory, it's run by worker processes of install_roots().
+
+    Returns numbers of operations of every kind, log messages, error that stopped installation
+    and event records if collect_events is set.
+    """
+    global events
+    events = EventStream() if collect_events else None
+    error = None
+    with deferred_output.capture() as records:
+        try:
+            plan = PotRepo(repo, config).install(names, force, full, home)
+        except HookError as e:
+            plan = e.plan
+            error = str(e)
+        except Exception as e:
+            plan = []
+            error = str(e)
+    counts = {}
+    for operation in plan:
+        counts[operation.kind] = counts.get(operation.kind, 0) + 1
+    messages = [(record.levelno, record.getMessage()) for record in records]
+    return counts, messages, error, [] if events is None else events.records
+
+
+def install_roots(homes, names=None, force=False, full=False, jobs=None, profile=None, dry_run=False):
+    """Install dotfiles into many home directories at once using pool of processes.
+
+    Configuration is loaded once and nothing depends on current directory or environment
+    of worker processes. Returns False if installation into some of the directories failed.
+    In dry run installation plans of all the directories are printed instead.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if not os.path.exists('config.yaml'):
+        logger.error('Configuration file not found.')
+        return False
+    repo = os.getcwd()
+    config = Config.load(os.path.join(repo, 'config.yaml'), profile)
+    homes = [os.path.abspath(home) for home in homes]
+    if dry_run:
+        session = PotRepo(repo, config, profile)
+        for home in homes:
+            print_result('==> {}'.format(home))
+            for operation in session.plan(names, force, full, home=home):
+                print_result(operation)
+        return True
+    success = True
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(install_root, repo, config, home, names, force, full, events is not None)
+                   for home in homes]
+        for home, future in zip(homes, futures):
+            counts, messages, error, records = future.result()
+            for record in records:
+                events.emit(home=home, **record)
+            logger.info('==> %s', home)
+            for level, message in messages:
+                logger.log(level, message)
+            if error is not None:
+                logger.error('Failed: %s', error)
+            failed = counts.get('fail', 0) + (error is not None)
+            success = success and not failed
+            logger.info('    %d installed, %d up to date, %d failed',
+                        sum(counts.values()) - counts.get('skip', 0) - counts.get('fail', 0),
+                        counts.get('skip', 0), failed)
+    return success
+
+
+class Operation(object):
+    """Single step of installation plan.
+
+    kind      - one of skip/link/sync/include/render/fail
+    remove    - whether existing target has to be removed first
+    error     - message reported by 'fail' operation
+    variables - variables used by 'render' operation
+    changed   - whether applying the operation changed the target, set by execute_operation()
+    found     - result of find_inclusions() for target of 'include' operation, set by settle_inclusions()
+    """
+
+    def __init__(self, kind, dotfile=None, src=None, dst=None, remove=False, error=None, variables=None):
+        self.kind = kind
+        self.dotfile = dotfile
+        self.src = src
+        self.dst = dst
+        self.remove = remove
+        self.error = error
+        self.variables = variables
+        self.changed = False
+        self.found = None
+
+    def __str__(self):
+        if self.kind == 'fail':
+            return '{:<8} {}'.format(self.kind, self.error)
+        return '{:<8} {} -> {}{}'.format(self.kind, self.dotfile.name, self.dst, ' (replace)' if self.remove else '')
+
+    def __repr__(self):
+        return '<Operation: {}>'.format(self)
+
+
+def expand_target(target, home=None, repo=None):
+    """Make absolute path of dotfile target.
+
+    Without explicit home directory it's expanded as usual, relative to repo (current directory
+    by default). Otherwise both '~' and relative targets are resolved against home.
+    """
+    if home is None:
+        return os.path.normpath(os.path.join(repo or os.getcwd(), os.path.expanduser(target)))
+    if target == '~' or target.startswith('~/'):
+        target = target[2:]
+    return os.path.abspath(os.path.join(home, target))
+
+
+def plan_install(names, names_to_dotfiles, manifest, force=False, full=False, repo=None, home=None,
+                 variables=None):
+    """Resolve dotfiles into the list of operations needed to install them.
+
+    State of file system is gathered in bulk: targets and sources are grouped by directory
+    and listed with one os.scandir per directory, so no further checks are needed when plan
+    is applied. Repeated names are planned once, order of the names is kept.
+
+    repo is the pot repository (current directory by default), home is the directory that
+    replaces user's home in targets. Absolute targets can't be installed into explicit home.
+    variables are used to render templates, only built-in ones are available by default.
+    """
+    repo = os.getcwd() if repo is None else repo
+    variables = host_variables(home) if variables is None else variables
+    variables_key = variables_digest(variables)
+    resolved = []
+    seen = set()
     for name in names:
-        if name not in names_to_dotfiles:
-            logger.error('No such file %s. Check configuration file.', name)
+        if name in seen:
+            continue
+        seen.add(name)
+        dotfile = names_to_dotfiles.get(name)
+        if dotfile is None:
+            resolved.append((name, None, None, None))
             continue
-        dotfile = names_to_dotfiles[name]
-        action = dotfile.action
-        src = os.path.abspath(os.path.join('dotfiles', dotfile.name))
-        if not os.path.exists(src):
-            logger.error('Dotfile "%s" doesn\'t exists', src)
+        if home is not None and os.path.isabs(dotfile.target):
+            resolved.append((name, dotfile, None, None))
             continue
-        dst = os.path.expanduser(dotfile.target)
-        # os.path.exists(path) returns False for broken symlinks,
-        # os.path.lexists does the right thing
-        if action in ('symlink', 'copy') and os.path.lexists(dst):
-            if force or broken_link(dst) or same_file_symlink(dst, src):
-                logger.debug('Removing %s', dst)
-                with report_action():
-                    # os.path.isdir always follows symlinks
-                    if real_dir(dst):
-                        shutil.rmtree(dst)
-                    else:
-                        os.remove(dst)
+        src = os.path.abspath(os.path.join(repo, 'dotfiles', dotfile.name))
+        dst = expand_target(dotfile.target, home, repo)
+        resolved.append((name, dotfile, src, dst))
+    entries = scan_targets(set(path for _, _, src, dst in resolved if src is not None for path in (src, dst)))
+    plan = []
+    for name, dotfile, src, dst in resolved:
+        if dotfile is None:
+            plan.append(Operation('fail', error='No such file {}. Check configuration file.'.format(name)))
+        elif src is None:
+            plan.append(Operation('fail', dotfile, error='Absolute target "{}" can\'t be installed into "{}"'.format(
+                dotfile.target, home)))
+        else:
+            operation = plan_dotfile(dotfile, src, dst, entries[src], entries[dst], manifest, force, full,
+                                     variables_key)
+            if operation.kind == 'render':
+                operation.variables = variables
+            plan.append(operation)
+    return settle_inclusions(plan, manifest)
+
+
+def settle_inclusions(plan, manifest):
+    """Turn 'include' operations which targets already contain their lines into 'skip'.
+
+    Every target is scanned once for all its lines. Settled dotfiles are recorded in manifest,
+    so the target is not scanned again until it's changed. Remaining 'include' operations keep
+    the result of the scan, so that the target isn't read again when plan is applied.
+    """
+    wanted = OrderedDict()
+    for op in plan:
+        if op.kind == 'include' and real_file(op.dst):
+            wanted.setdefault(op.dst, set()).add(inclusion_line(op.src))
+    if not wanted:
+        return plan
+    found = {dst: find_inclusions(dst, lines) for dst, lines in wanted.items()}
+    settled = []
+    for op in plan:
+        if op.kind == 'include' and op.dst in found:
+            if inclusion_line(op.src) in found[op.dst][0]:
+                manifest.record(op.dotfile, op.src, op.dst)
+                op = Operation('skip', op.dotfile, op.src, op.dst)
             else:
-                logger.error('File "%s" exists. Delete it manually or use force mode to override it', dst)
+                op.found = found[op.dst]
+        settled.append(op)
+    return settled
+
+
+def plan_dotfile(dotfile, src, dst, src_entry, dst_entry, manifest, force=False, full=False, variables_key=None):
+    """Decide how to install dotfile given os.DirEntry objects of its source and target (or None).
+
+    variables_key is the digest of template variables, see Manifest.is_current().
+    """
+    action = dotfile.action
+    # os.path.exists(path) returns False for broken symlinks, source has to be checked the same way,
+    # only dotfiles installed from bundle are kept without their sources
+    missing = src_entry is None or broken_link(src_entry)
+    if missing and not manifest.from_bundle(dotfile):
+        return Operation('fail', dotfile, src, dst, error='Dotfile "{}" doesn\'t exists'.format(src))
+    if not full and dst_entry is not None:
+        if manifest.is_current(dotfile, src, dst, dst_entry.stat(follow_symlinks=False), variables_key):
+            return Operation('skip', dotfile, src, dst)
+    if missing:
+        return Operation('fail', dotfile, src, dst, error='Dotfile "{}" doesn\'t exists'.format(src))
+    kind = {'symlink': 'link', 'copy': 'sync', 'include': 'include', 'template': 'render'}.get(action)
+    if kind is None:
+        return Operation('fail', dotfile, src, dst, error='Unknown action "{}" of dotfile "{}"'.format(
+            action, dotfile.name))
+    if action == 'template' and not src_entry.is_file():
+        return Operation('fail', dotfile, src, dst, error='Template "{}" is not a file'.format(src))
+    remove = False
+    if action in ('symlink', 'copy', 'template') and dst_entry is not None:
+        same_kind = real_dir(dst_entry) if real_dir(src_entry) else real_file(dst_entry)
+        if action in ('copy', 'template') and (force or manifest.owns(dotfile, dst)) and same_kind:
+            # previous copy is updated in place
+            pass
+        elif force or broken_link(dst_entry) or same_file_symlink(dst_entry, src):
+            remove = True
+        else:
+            return Operation('fail', dotfile, src, dst, error='File "{}" exists. Delete it manually or use '
+                                                              'force mode to override it'.format(dst))
+    return Operation(kind, dotfile, src, dst, remove)
+
+
+def apply_plan(plan, manifest, jobs=1, manifest_path=MANIFEST_NAME, store=None):
+    """Execute operations of installation plan and save the manifest.
+
+    Copied files are cloned from object store if it's given.
+    """
+    included = [op for op in plan if op.kind == 'include']
+    # targets were scanned by planning, lines found in them are copied since inclusions add scheduled ones
+    inclusions = Inclusions(((op.dst, inclusion_line(op.src)) for op in included),
+                            dict((op.dst, (set(op.found[0]), op.found[1])) for op in included if op.found is not None))
+    try:
+        if jobs > 1:
+            run_in_order([(op.dst, lambda op=op: execute(op, manifest, inclusions, store)) for op in plan], jobs)
+        else:
+            for operation in plan:
+                execute(operation, manifest, inclusions, store)
+    finally:
+        try:
+            inclusions.flush(manifest)
+            if store is not None:
+                store.save()
+        finally:
+            if manifest.modified:
+                with timed('manifest.save'):
+                    manifest.save(manifest_path)
+
+
+def inclusion_line(src):
+    return DEFAULT_INCLUSION_FORMAT.format(src=src)
+
+
+def execute(operation, manifest, inclusions, store=None):
+    """Apply single operation of installation plan, emitting its record if event stream is enabled.
+
+    Inclusions are only scheduled, they are written and recorded in manifest by inclusions.flush().
+    """
+    if events is None:
+        execute_operation(operation, manifest, inclusions, store)
+        return
+    start = time.perf_counter()
+    name = None if operation.dotfile is None else operation.dotfile.name
+    try:
+        written = execute_operation(operation, manifest, inclusions, store)
+    except Exception as e:
+        events.action('install', operation.dst, operation.kind, 'failed', start, dotfile=name, error=str(e))
+        raise
+    if operation.kind == 'fail':
+        events.action('install', operation.dst, operation.kind, 'failed', start, dotfile=name, error=operation.error)
+    else:
+        events.action('install', operation.dst, operation.kind, 'skipped' if operation.kind == 'skip' else 'ok',
+                      start, written, dotfile=name)
+
+
+def execute_operation(operation, manifest, inclusions, store=None):
+    """Apply single operation of installation plan. Returns number of written bytes."""
+    kind, dotfile, src, dst = operation.kind, operation.dotfile, operation.src, operation.dst
+    if kind == 'skip':
+        logger.debug('Skipping "%s": already installed', dst)
+        return 0
+    if dotfile is not None:
+        manifest.forget(dotfile.name)
+    if kind == 'fail':
+        logger.error(operation.error)
+        return 0
+    written = 0
+    if operation.remove:
+        logger.debug('Removing %s', dst)
+        with report_action(), timed('install.remove', target=dst):
+            remove_path(dst)
+    if kind in ('link', 'sync', 'render'):
+        # nested targets discovered by init (e.g. ~/.config/nvim) may be the first ones in their directory,
+        # sibling targets installed concurrently may create it at the same time
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if kind == 'link':
+        with report_action('Symlinking "{}" -> "{}"', dst, src), timed('install.symlink', target=dst):
+            os.symlink(src, dst)
+        operation.changed = True
+    elif kind == 'sync':
+        with report_action('Copying "{}" as "{}"', src, dst), timed('install.copy', target=dst):
+            written = sync_tree(src, dst, store)
+        operation.changed = operation.remove or written > 0
+    elif kind == 'render':
+        with report_action('Rendering "{}" as "{}"', src, dst), timed('install.render', target=dst):
+            written = render_file(src, dst, operation.variables)
+        operation.changed = operation.remove or written > 0
+        manifest.record(dotfile, src, dst, variables_digest(operation.variables))
+        return written
+    elif kind == 'include':
+        line = inclusion_line(src)
+        with report_action('Including "{}" in "{}"', src, dst), timed('install.include', target=dst):
+            if inclusions.include(dotfile, src, dst, line):
+                logger.debug('Appending "%s" to "%s"', line, dst)
+                # line is actually written by inclusions.flush()
+                written = len(line) + 1
+                operation.changed = True
+            else:
+                logger.info('  Skipped: "%s" is already found', line)
+        return written
+    manifest.record(dotfile, src, dst)
+    return written
+
+
+def remove_links(dotfiles):
+    """Remove symlinks created for dotfiles which are not in configuration anymore."""
+    with manifest_lock(os.getcwd()):
+        manifest = Manifest.load(MANIFEST_NAME)
+        for dotfile in dotfiles:
+            src = os.path.abspath(os.path.join('dotfiles', dotfile.name))
+            dst = os.path.abspath(os.path.expanduser(dotfile.target))
+            if dotfile.action == 'symlink' and same_file_symlink(dst, src):
+                with report_action('Removing symlink "{}"', dst, suppress=True):
+                    os.remove(dst)
+            manifest.forget(dotfile.name)
+        if manifest.modified:
+            manifest.save(MANIFEST_NAME)
+
+
+class PollingWatcher(object):
+    """Detects changes in directory trees by comparing their snapshots periodically."""
+
+    def __init__(self, paths, interval=1.0):
+        self.paths = paths
+        self.interval = interval
+        self.snapshot = self._take_snapshot()
+
+    def _take_snapshot(self):
+        snapshot = {}
+        for path, recursive in self.paths:
+            if not os.path.exists(path):
                 continue
-        if action == 'symlink':
-            with report_action('Symlinking "{}" -> "{}"'.format(dst, src)):
-                os.symlink(src, dst)
-        elif action == 'copy':
-            with report_action('Copying "{}" as "{}"'.format(src, dst)):
-                shutil.copytree(src, dst)
-        elif action == 'include':
-            inclusion_line = DEFAULT_INCLUSION_FORMAT.format(src=src)
-            pattern = re.escape(inclusion_line)
-            pattern = r'^\s*{}\s*$'.format(pattern)
-            pattern = re.compile(pattern, re.MULTILINE)
-            with report_action('Including "{}" in "{}"'.format(src, dst)):
-                with open(dst, 'r+') as target:
-                    logger.debug('checking for previous inclusion in "%s"...', dst)
-                    if pattern.search(target.read()):
-                        logger.info('  Skipped: "%s" is already found', inclusion_line)
-                        continue
-                    logger.debug('Appending "%s" to "%s"', inclusion_line, dst)
-                    target.write(inclusion_line + '\n')
+            # git metadata changes on every commit, it's not watched like in InotifyWatcher
+            items = iter_tree(path, exclude={'.git'}) if recursive else [('', os.lstat(path))]
+            for relpath, st in items:
+                snapshot[os.path.join(path, relpath) if relpath else path] = (st.st_ino, st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def read(self, timeout=None):
+        """Wait for changes for at most timeout seconds (forever if it's None) and return changed paths."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            snapshot = self._take_snapshot()
+            changed = set(path for path in set(snapshot) | set(self.snapshot)
+                          if snapshot.get(path) != self.snapshot.get(path))
+            self.snapshot = snapshot
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+            delay = self.interval if deadline is None else min(self.interval, max(deadline - time.time(), 0))
+            time.sleep(delay)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Detects changes in directory trees with inotify(7).
+
+    None among returned paths means that the kernel queue overflowed and some events were lost.
+    """
+
+    def __init__(self, paths):
+        import ctypes
+        import ctypes.util
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}
+        # directories watched only for changes of particular files in them
+        self.files = {}
+        # directories of watched trees, kernel returns the same descriptor if such directory is
+        # watched for particular files too, changes of all the files in it are reported then
+        self.recursive = set()
+        for path, recursive in paths:
+            if recursive:
+                self._add_tree(path)
+            else:
+                wd = self._add_watch(os.path.dirname(path))
+                self.files.setdefault(wd, set()).add(path)
+
+    def _add_watch(self, path, recursive=False):
+        import ctypes
+
+        wd = self._libc.inotify_add_watch(self.fd, path.encode('utf-8'), WATCH_EVENTS)
+        if wd < 0:
+            logger.debug('Can\'t watch "%s": %s', path, os.strerror(ctypes.get_errno()))
+            return None
+        self.dirs[wd] = path
+        if recursive:
+            self.recursive.add(wd)
+        return wd
+
+    def _add_tree(self, path):
+        """Watch directory with all its subdirectories and return paths found in them."""
+        self._add_watch(path, recursive=True)
+        found = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            if '.git' in dirnames:
+                dirnames.remove('.git')
+            for name in dirnames:
+                self._add_watch(os.path.join(dirpath, name), recursive=True)
+            found.extend(os.path.join(dirpath, name) for name in dirnames + filenames)
+        return found
+
+    def read(self, timeout=None):
+        """Wait for changes for at most timeout seconds (forever if it's None) and return changed paths."""
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        data = os.read(self.fd, 1 << 16)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+            offset += struct.calcsize('iIII')
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                changed.add(None)
+                continue
+            if wd not in self.dirs:
+                continue
+            path = os.path.join(self.dirs[wd], name) if name else self.dirs[wd]
+            if name == '.git' or (wd in self.files and wd not in self.recursive and path not in self.files[wd]):
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # files could be created in new directory before it's watched
+                changed.update(self._add_tree(path))
+            if mask & IN_DELETE_SELF:
+                del self.dirs[wd]
+                self.recursive.discard(wd)
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(paths, interval=1.0):
+    """Create inotify based watcher falling back to polling where inotify isn't available.
+
+    paths is a list of (path, recursive) pairs.
+    """
+    try:
+        return InotifyWatcher(paths)
+    except (OSError, AttributeError) as e:
+        logger.debug('Inotify is not available, falling back to polling: %s', e)
+        return PollingWatcher(paths, interval)
+
+
+def collect_changes(watcher, delay=0.5):
+    """Wait for changes and coalesce all of them coming until there is a pause of delay seconds."""
+    changed = watcher.read()
+    while True:
+        more = watcher.read(delay)
+        if not more:
+            return changed
+        changed |= more
+
 
+def reconcile(config, paths, force=False, jobs=1, profile=None):
+    """Apply changes of the files in pot repository. Returns actual configuration.
+
+    Changes of configuration file or any of the files it includes are compared dotfile by dotfile,
+    templates are rendered again if their variables have changed.
+    """
+    config_path = os.path.abspath('config.yaml')
+    dotfiles_dir = os.path.abspath('dotfiles')
+    names = set()
+    if None in paths or config_path in paths or any(path in paths for path in config.sources):
+        new_config = Config.load(config_path, profile)
+        old_dotfiles = {df.name: df for df in config.dotfiles}
+        new_dotfiles = {df.name: df for df in new_config.dotfiles}
+        remove_links([df for name, df in old_dotfiles.items() if new_dotfiles.get(name) != df])
+        names.update(name for name, df in new_dotfiles.items() if old_dotfiles.get(name) != df)
+        if new_config.template_variables() != config.template_variables():
+            names.update(name for name, df in new_dotfiles.items() if df.action == 'template')
+        config = new_config
+    if None in paths:
+        names.update(df.name for df in config.dotfiles)
+    relpaths = [os.path.relpath(path, dotfiles_dir) for path in paths
+                if path is not None and path.startswith(dotfiles_dir + os.sep)]
+    names.update(df.name for df in affected_dotfiles(config.dotfiles, relpaths))
+    if names:
+        install([df.name for df in config.dotfiles if df.name in names], force, jobs, profile=profile)
+    return config
+
+
+def watch(force=False, jobs=1, interval=1.0, delay=0.5, profile=None):
+    """Keep dotfiles installed, reinstalling them as soon as pot repository changes."""
+    if not os.path.exists('config.yaml'):
+        logger.error('Configuration file not found.')
+        return
+    config = Config.load(os.path.join(os.getcwd(), 'config.yaml'), profile)
+    install(None, force, jobs, profile=profile)
 
-def grab(path, force=False):
+    def watched_paths(config):
+        # included files of configuration are watched as well
+        sources = set(config.sources) | {os.path.abspath('config.yaml')}
+        return [(path, False) for path in sorted(sources)] + [(os.path.abspath('dotfiles'), True)]
+
+    paths = watched_paths(config)
+    watcher = make_watcher(paths, interval)
+    logger.info('Watching for changes, press Ctrl+C to stop')
+    try:
+        while True:
+            changed = collect_changes(watcher, delay)
+            logger.debug('Changed paths: %s', sorted(changed, key=str))
+            with report_action(suppress=True):
+                config = reconcile(config, changed, force, jobs, profile)
+            if watched_paths(config) != paths:
+                paths = watched_paths(config)
+                watcher.close()
+                watcher = make_watcher(paths, interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def update(force=False, jobs=1, profile=None):
+    """Pull dotfiles repository and reinstall changed dotfiles. Returns False if it can't be pulled or reinstalled."""
+    if not os.path.exists('config.yaml'):
+        logger.error('Configuration file not found.')
+        return False
+    if not os.path.exists(os.path.join('dotfiles', '.git')):
+        logger.error('Dotfiles directory is not a git repository.')
+        return False
+    with PotRepo(os.getcwd()).lock(exclusive=True), report_action('Pulling dotfiles repository'):
+        changed_paths = pull_git_repo(os.getcwd())
+    config = Config.load(os.path.join(os.getcwd(), 'config.yaml'), profile)
+    names = [df.name for df in affected_dotfiles(config.dotfiles, changed_paths)]
+    if not names:
+        logger.info('All dotfiles are up to date.')
+        return
+    return install(names, force, jobs, profile=profile)
+
+
+def dotfile_status(dotfile, src, dst, entry, manifest):
+    """Classify installed dotfile as 'ok', 'missing', 'broken' or 'diverged'.
+
+    entry is os.DirEntry of the target or None if it doesn't exist. Copied, rendered and included
+    dotfiles are considered installed correctly only if manifest confirms that target is left untouched
+    since installation, except that included files are checked for inclusion line as a fallback.
+    Copied and rendered dotfiles which source was removed are 'broken' like symlinks to it,
+    unless they were installed from bundle.
+    """
+    if entry is None:
+        return 'missing'
+    if broken_link(entry):
+        return 'broken'
+    action = dotfile.action
+    if action == 'symlink':
+        return 'ok' if same_file_symlink(entry, src) else 'diverged'
+    if action in ('copy', 'template'):
+        if not os.path.lexists(src) and not manifest.from_bundle(dotfile):
+            return 'broken'
+        if real_dir(entry) or real_file(entry):
+            if manifest.target_unchanged(dotfile, src, dst, entry.stat(follow_symlinks=False)):
+                return 'ok'
+        return 'diverged'
+    if action == 'include':
+        if manifest.target_unchanged(dotfile, src, dst, entry.stat(follow_symlinks=False)):
+            return 'ok'
+        if entry.is_file() and has_inclusion(dst, DEFAULT_INCLUSION_FORMAT.format(src=src)):
+            return 'ok'
+        return 'diverged'
+    return 'diverged'
+
+
+def status(names=None, porcelain=False, profile=None):
+    """Print state of installed dotfiles. Returns False if any of them isn't installed correctly."""
+    if not os.path.exists('config.yaml'):
+        logger.error('Configuration file not found.')
+        return False
+    all_ok = True
+    for dotfile, dst, state in PotRepo(os.getcwd(), profile=profile).status(names):
+        all_ok = all_ok and state == 'ok'
+        if porcelain:
+            print_result('{}\t{}\t{}'.format(state, dotfile.name, dst))
+        else:
+            print_result('{:<9} {} -> {}'.format(state, dotfile.name, dst))
+    return all_ok
+
+
+def chain_keys(targets):
+    """Map every target to the outermost target among its ancestors (including itself).
+
+    Tasks sharing the key touch the same part of file system and must not be reordered.
+    """
+    keys = {}
+    known = set(t for t in targets if t is not None)
+    for target in known:
+        key = parent = target
+        while True:
+            parent, child = os.path.dirname(parent), parent
+            if parent == child:
+                break
+            if parent in known:
+                key = parent
+        keys[target] = key
+    return keys
+
+
+def run_in_order(tasks, jobs):
+    """Run (target, func) tasks on a pool of threads as if they were run one by one.
+
+    Tasks with the same target (or with nested targets) are executed sequentially in
+    original order, output is replayed in original order and the first error is re-raised
+    after output of all the preceding tasks, exactly like in the serial run. Once a task fails,
+    tasks following it aren't started anymore, though the preceding ones are still run.
+    """
+    keys = chain_keys([target for target, _ in tasks])
+    chains = OrderedDict()
+    for i, (target, _) in enumerate(tasks):
+        # tasks without target don't touch file system and can't conflict
+        key = keys[target] if target is not None else ('task', i)
+        chains.setdefault(key, []).append(i)
+    # index of the first failed task shared by all the chains
+    failed = [len(tasks)]
+    failed_lock = threading.Lock()
+
+    def run_chain(indices):
+        results = {}
+        for i in indices:
+            if i > failed[0]:
+                break
+            with deferred_output.capture() as records:
+                try:
+                    tasks[i][1]()
+                    error = None
+                except Exception as e:
+                    error = e
+            results[i] = (records, error)
+            if error is not None:
+                with failed_lock:
+                    failed[0] = min(failed[0], i)
+                break
+        return results
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        for indices in chains.values():
+            future = pool.submit(run_chain, indices)
+            for i in indices:
+                futures[i] = future
+        try:
+            for i in range(len(tasks)):
+                records, error = futures[i].result()[i]
+                for record in records:
+                    logger.handle(record)
+                if error is not None:
+                    raise error
+        finally:
+            for future in futures.values():
+                future.cancel()
+
+
+def move_file(src, dst):
+    """Move file or directory with rename(2) if possible, otherwise copy it and remove original.
+
+    Returns number of written bytes.
+    """
+    try:
+        os.rename(src, dst)
+        return 0
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    logger.debug('"%s" and "%s" are on different file systems, copying', src, dst)
+    written = sync_tree(src, dst)
+    remove_path(src)
+    return written
+
+
+def contract_user(path):
+    """Replace home directory in absolute path with tilde."""
+    home = os.path.expanduser('~')
+    if path == home or path.startswith(home.rstrip(os.sep) + os.sep):
+        return '~' + path[len(home.rstrip(os.sep)):]
+    return path
+
+
+def expand_patterns(patterns):
+    """Expand glob patterns, patterns without matches are kept as is to be reported later."""
+    paths = []
+    for pattern in patterns:
+        pattern = os.path.expanduser(pattern)
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else []
+        paths.extend(matches or [pattern])
+    return paths
+
+
+def grab_file(path, dotfiles_dir, force=False):
+    """Move single file into dotfiles directory and symlink it back. Returns its DotFile or None on failure.
+
+    Files already linked to the same name in dotfiles directory are left as they are.
+    """
+    start = time.perf_counter()
+    filename = os.path.basename(path)
+    dst_file = os.path.join(dotfiles_dir, filename)
+    error = None
+    written = 0
+    if not os.path.lexists(path):
+        error = 'File "{}" doesn\'t exist'.format(path)
+    elif same_file_symlink(path, dst_file):
+        # e.g. matched again by the same pattern, force mode would replace the file with the link itself
+        logger.info('Skipped: "%s" is already grabbed', path)
+        if events is not None:
+            events.action('grab', path, 'grab', 'skipped', start, dotfile=filename)
+        return DotFile(filename, target=contract_user(path))
+    elif os.path.islink(path) and os.path.realpath(path).startswith(os.path.realpath(dotfiles_dir) + os.sep):
+        error = '"{}" is a link into "{}"'.format(path, dotfiles_dir)
+    elif os.path.lexists(dst_file) and not force:
+        error = '"{}" already exists in "{}"'.format(filename, dotfiles_dir)
+    if error is not None:
+        logger.error(error)
+    else:
+        try:
+            with report_action('Moving "{}" to "{}"', path, dotfiles_dir), timed('grab.move', path=path):
+                if os.path.lexists(dst_file):
+                    remove_path(dst_file)
+                written = move_file(path, dst_file)
+            with report_action('Symlinking "{}" -> "{}"', path, dst_file), timed('grab.symlink', path=path):
+                os.symlink(dst_file, path)
+        except Exception as e:
+            error = str(e)
+    if events is not None:
+        events.action('grab', path, 'grab', 'ok' if error is None else 'failed', start, written,
+                      dotfile=filename, **({} if error is None else {'error': error}))
+    if error is not None:
+        return None
+    return DotFile(filename, target=contract_user(path))
+
+
+def grab(paths, force=False):
+    """Grab files into global repository (see PotRepo.grab)."""
     global_repo = os.path.expanduser(os.getenv('POT_HOME', DEFAULT_POT_HOME))
     logger.debug('using %s as global repo', global_repo)
-    dst_dir = os.path.join(global_repo, 'dotfiles')
-    dst_file = os.path.join(dst_dir, os.path.basename(path))
-    with report_action('Moving "{}" to "{}"'.format(path, dst_dir)):
-        filename = os.path.basename(path)
-        if os.path.exists(dst_file) and not force:
-            logger.error('"%s" already exists in "%s"', filename, dst_dir)
-            return
-            # move always overwrite its target
-        shutil.move(path, dst_file)
-    with report_action('Symlinking "{}" -> "{}"'.format(path, dst_file)):
-        os.symlink(dst_file, path)
+    return PotRepo(global_repo).grab(paths, force)
+
+
+def register_dotfiles(config_path, dotfiles):
+    """Add dotfiles to configuration file (replacing ones with the same names) in one atomic rewrite."""
+    names = [df.name for df in dotfiles]
+    if len(set(names)) != len(names):
+        raise ValueError('Dotfiles with the same name: {}'.format(
+            ', '.join(sorted(set(name for name in names if names.count(name) > 1)))))
+    # file is rewritten as is, without merging includes and profiles into it
+    config_file = ConfigFile(config_path)
+    config_file.add_dotfiles(dotfiles)
+    with report_action('Updating "{}"', config_path), timed('config.write'):
+        config_file.write()
+
+
+def install_command_handler(args):
+    names = args.dotfiles or None
+    if args.from_bundle:
+        return install_bundle(args.from_bundle, args.force)
+    if args.root or args.homes:
+        homes = list(args.root)
+        success = True
+        for pattern in args.homes:
+            matches = [path for path in expand_patterns([pattern]) if os.path.isdir(path)]
+            if not matches:
+                # e.g. mistyped pattern, installing nothing isn't a success
+                logger.error('No directories match "%s"', pattern)
+                success = False
+            homes.extend(matches)
+        # each of the roots is handled by separate process
+        return install_roots(homes, names, args.force, args.full, args.jobs if args.jobs > 1 else None,
+                             args.profile, args.dry_run) and success
+    return install(names, args.force, args.jobs, args.full, args.dry_run, args.profile)
+
+
+# commands and their options offered by shell completion
+COMPLETIONS = {
+    None: ['-h', '--help', '-v', '-q', '--quiet', '-f', '--force', '--timings', '--trace', '--events'],
+    'init': ['--git', '--depth', '--filter', '-j', '--jobs', '--mirror', '--store'],
+    'install': ['-j', '--jobs', '--full', '-n', '--dry-run', '--root', '--homes', '--profile', '--from-bundle'],
+    'update': ['-j', '--jobs', '--profile'],
+    'watch': ['-j', '--jobs', '--interval', '--delay', '--profile'],
+    'status': ['--porcelain', '--profile'],
+    'grab': [],
+    'bundle': ['-o', '--output', '--profile'],
+}
+# commands taking names of dotfiles as arguments
+DOTFILE_COMMANDS = ('install', 'status')
+
+
+def dotfile_names(repo):
+    """Read names of dotfiles from the index, rebuilding it only if configuration is newer."""
+    config_path = os.path.join(repo, 'config.yaml')
+    index_path = os.path.join(repo, NAMES_INDEX_NAME)
+    try:
+        config_mtime = os.stat(config_path).st_mtime_ns
+    except OSError:
+        return []
+    try:
+        if os.stat(index_path).st_mtime_ns >= config_mtime:
+            with open(index_path) as fd:
+                return fd.read().splitlines()
+    except OSError:
+        pass
+    config = Config.load(config_path)
+    config.write_names_index(index_path)
+    return [df.name for df in config.dotfiles]
+
+
+def complete(words):
+    """Print completion candidates for the last of the words following 'pot' on command line."""
+    if not words:
+        words = ['']
+    current = words[-1]
+    command = None
+    for word in words[:-1]:
+        if word in COMPLETIONS:
+            command = word
+            break
+    candidates = list(COMPLETIONS[command])
+    if command is None:
+        candidates += sorted(name for name in COMPLETIONS if name is not None)
+    elif command in DOTFILE_COMMANDS and not current.startswith('-'):
+        repo = os.getcwd()
+        if not os.path.exists(os.path.join(repo, 'config.yaml')):
+            repo = os.path.expanduser(os.getenv('POT_HOME', DEFAULT_POT_HOME))
+        candidates = dotfile_names(repo)
+    sys.stdout.write(''.join(c + '\n' for c in candidates if c.startswith(current)))
 
 
 def main():
+    # completion is handled before heavy argument parser is even imported
+    if sys.argv[1:2] == ['complete']:
+        complete(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(prog='pot', description=__doc__)
     parser.add_argument('-v', action='store_true', dest='verbose', help='verbose mode')
+    parser.add_argument('-q', '--quiet', action='store_true', help='report only errors')
+    parser.add_argument('--events', metavar='FILE',
+                        help='append JSON record of every action to FILE, "-" for stdout (implies --quiet)')
     parser.add_argument('-f', '--force', action='store_true', help='overwrite existing files')
     # parser.add_argument('-F', '--fail-fast', action='store_true', help='stop on first error')
+    parser.add_argument('--timings', action='store_true', help='print time spent in every phase')
+    parser.add_argument('--trace', metavar='FILE', help='save phases timeline in Chrome trace format')
     subparsers = parser.add_subparsers()
 
     # new storage initialization command
     init_command = subparsers.add_parser('init', help='create pot repository and populate default config.yaml')
     init_command.add_argument('location', nargs='?', default='.', help='pot repository')
     init_command.add_argument('--git', metavar='URL', help='git repository URL')
-    init_command.set_defaults(func=lambda args: init(args.location, git_url=args.git))
+    init_command.add_argument('--depth', type=int, metavar='N', help='create shallow clone of N last commits')
+    init_command.add_argument('--filter', metavar='SPEC', dest='filter_spec',
+                              help='create partial clone, e.g. with blob:none filter')
+    init_command.add_argument('-j', '--jobs', type=int, metavar='N', help='number of submodules fetched in parallel')
+    init_command.add_argument('--mirror', metavar='DIR', help='directory of local repository mirrors to reuse')
+    init_command.add_argument('--store', action='store_true',
+                              help='share large files of copied dotfiles with other repositories through object store '
+                                   'in $POT_HOME')
+    init_command.set_defaults(func=lambda args: init(args.location, git_url=args.git, store=args.store,
+                                                     depth=args.depth, filter_spec=args.filter_spec,
+                                                     jobs=args.jobs, mirror=args.mirror))
 
     # dotfile installation command
     install_command = subparsers.add_parser('install', help='install dotfiles in system')
     install_command.add_argument('dotfiles', nargs='*', help='dotfiles names to install')
-    install_command.set_defaults(func=lambda args: install(args.dotfiles or None, args.force))
+    install_command.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                                 help='number of dotfiles installed simultaneously')
+    install_command.add_argument('--full', action='store_true',
+                                 help='reinstall dotfiles even if they are up to date according to manifest')
+    install_command.add_argument('-n', '--dry-run', action='store_true', help='print installation plan and exit')
+    install_command.add_argument('--root', action='append', default=[], metavar='DIR',
+                                 help='install into DIR instead of home directory, can be repeated')
+    install_command.add_argument('--homes', action='append', default=[], metavar='PATTERN',
+                                 help='install into every directory matching glob PATTERN, e.g. "/home/*"')
+    install_command.add_argument('--profile', default=os.getenv('POT_PROFILE'), metavar='NAME',
+                                 help='install dotfiles of profile defined in config.yaml (default $POT_PROFILE)')
+    install_command.add_argument('--from-bundle', metavar='FILE',
+                                 help='make current directory pot repository and install dotfiles from bundle')
+    install_command.set_defaults(func=install_command_handler)
+
+    # repository update command
+    update_command = subparsers.add_parser('update', help='pull dotfiles repository and reinstall changed dotfiles')
+    update_command.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                                help='number of dotfiles installed simultaneously')
+    update_command.add_argument('--profile', default=os.getenv('POT_PROFILE'), metavar='NAME',
+                                help='reinstall dotfiles of profile defined in config.yaml (default $POT_PROFILE)')
+    update_command.set_defaults(func=lambda args: update(args.force, args.jobs, args.profile))
+
+    # live reinstallation command
+    watch_command = subparsers.add_parser('watch', help='reinstall dotfiles whenever repository changes')
+    watch_command.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                               help='number of dotfiles installed simultaneously')
+    watch_command.add_argument('--interval', type=float, default=1.0, metavar='SECONDS',
+                               help='polling interval used where inotify is not available')
+    watch_command.add_argument('--delay', type=float, default=0.5, metavar='SECONDS',
+                               help='wait for this pause in changes before reinstalling')
+    watch_command.add_argument('--profile', default=os.getenv('POT_PROFILE'), metavar='NAME',
+                               help='keep dotfiles of profile defined in config.yaml installed (default $POT_PROFILE)')
+    watch_command.set_defaults(func=lambda args: watch(args.force, args.jobs, args.interval, args.delay,
+                                                       args.profile))
+
+    # installation state command
+    status_command = subparsers.add_parser('status', help='show which dotfiles are installed correctly, '
+                                                          'exit with status 1 if some of them are not')
+    status_command.add_argument('dotfiles', nargs='*', help='dotfiles names to check')
+    status_command.add_argument('--porcelain', action='store_true',
+                                help='print tab separated status, name and target of each dotfile')
+    status_command.add_argument('--profile', default=os.getenv('POT_PROFILE'), metavar='NAME',
+                                help='check dotfiles of profile defined in config.yaml (default $POT_PROFILE)')
+    status_command.set_defaults(func=lambda args: status(args.dotfiles or None, args.porcelain, args.profile))
+
+    # shell completion command, actually handled before parsing of arguments
+    complete_command = subparsers.add_parser('complete', help='print shell completion candidates')
+    complete_command.add_argument('words', nargs='*', help='command line words after "pot", the last one is completed')
+    complete_command.set_defaults(func=lambda args: complete(args.words))
 
     # dotfile capturing command
-    grab_command = subparsers.add_parser('grab', help='move dotfile to repository and symlink it')
-    grab_command.add_argument('path', help='path to dotfile')
-    grab_command.set_defaults(func=lambda args: grab(args.path, args.force))
+    grab_command = subparsers.add_parser('grab', help='move dotfiles to repository, symlink and register them')
+    grab_command.add_argument('paths', nargs='+', metavar='path', help='paths or glob patterns of dotfiles')
+    grab_command.set_defaults(func=lambda args: grab(args.paths, args.force))
+
+    # offline bundle command
+    bundle_command = subparsers.add_parser('bundle', help='pack configuration and dotfiles into single archive')
+    bundle_command.add_argument('-o', '--output', default=DEFAULT_BUNDLE_NAME, metavar='FILE',
+                                help='archive to create, compression is chosen by extension (default %(default)s)')
+    bundle_command.add_argument('--profile', default=os.getenv('POT_PROFILE'), metavar='NAME',
+                                help='bundle dotfiles of profile defined in config.yaml (default $POT_PROFILE)')
+    bundle_command.set_defaults(func=lambda args: bundle(args.output, args.profile))
 
     args = parser.parse_args()
 
-    if args.verbose:
-        debug_handler = logging.StreamHandler()
-        debug_handler.addFilter(RangeFilter(minlevel=logging.DEBUG, maxlevel=logging.DEBUG))
-        debug_handler.setFormatter(logging.Formatter(VERBOSE_MESSAGE_FORMAT))
-        logger.addHandler(debug_handler)
+    setup_logging(args.verbose, args.quiet or args.events is not None)
 
+    global profiler, events
+    if args.timings or args.trace:
+        profiler = Profiler()
+    if args.events:
+        events = EventStream.open(args.events)
     try:
-        args.func(args)
+        with timed('total'):
+            result = args.func(args)
     except Exception as e:
         logger.error(e)
+        result = False
+    finally:
+        if args.timings:
+            profiler.print_summary()
+        if args.trace:
+            profiler.write_trace(args.trace)
+        if events is not None:
+            events.close()
+    if result is False:
         sys.exit(1)
 
 
@@ -3,6 +3,7 @@ from setuptools import setup
 setup(
     name='pot',
     version='0.1',
+    python_requires='>=3.7',
     py_modules=['pot'],
     install_requires=[
         'PyYAML'
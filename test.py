@@ -20,12 +20,21 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from contextlib import contextmanager
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+import argparse
+import io
+import subprocess
+import json
+import shutil
 import tempfile
+import threading
 import time
 import logging
+import logging.handlers
+import sys
 
 import os
+import stat
 import pot
 from pot import cd, Config, DotFile
 import nose
@@ -139,8 +148,17 @@ def make_hierarchy(d):
 def updated_env(**kwargs):
     old_env = os.environ.copy()
     os.environ.update(kwargs)
-    yield
-    os.environ = old_env
+    try:
+        yield
+    finally:
+        # os.environ is restored in place, so that subprocesses of later tests see changes of it
+        os.environ.clear()
+        os.environ.update(old_env)
+
+
+def git(*args):
+    subprocess.check_call(('git', '-c', 'user.name=pot', '-c', 'user.email=pot@localhost') + args,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 
 def test_config_serialization():
@@ -164,6 +182,28 @@ dotfiles:
     eq_(expected_string, config.to_yaml())
 
 
+def test_config_cache():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'config.yaml': 'dotfiles: [{name: .vimrc}]'
+        })
+        # configuration modified long enough ago can be checked by its stat alone
+        os.utime('config.yaml', (time.time() - 10, time.time() - 10))
+        eq_(Config.load('config.yaml'), Config([DotFile('.vimrc')]))
+        with open(pot.CONFIG_CACHE_NAME) as fd:
+            eq_(json.load(fd)['version'], pot.CONFIG_CACHE_VERSION)
+        from_yaml, file_key = vars(Config)['from_yaml'], pot.file_key
+        Config.from_yaml = pot.file_key = None
+        try:
+            # warm start doesn't read and parse YAML at all
+            eq_(Config.load('config.yaml'), Config([DotFile('.vimrc')]))
+        finally:
+            Config.from_yaml, pot.file_key = from_yaml, file_key
+        with open('config.yaml', 'w') as fd:
+            fd.write('dotfiles: [{name: .bashrc}]')
+        eq_(Config.load('config.yaml'), Config([DotFile('.bashrc')]))
+
+
 def test_init():
     with temp_cwd(prefix='pot-test'):
         make_hierarchy({
@@ -276,6 +316,400 @@ def test_force_mode():
         yield _test_existing, content, True, True
 
 
+def test_parallel_install():
+    names = ['.rc{}'.format(i) for i in range(10)]
+    config = Config([DotFile(name, target='~/.bashrc', action='include') for name in names] +
+                    [DotFile('.vimrc'), DotFile('.vim', action='copy')])
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'pot': {
+                'dotfiles': dict([(name, '') for name in names], **{'.vimrc': '', '.vim': {'colors': {}}}),
+                'config.yaml': config.to_yaml()
+            },
+            'home': {
+                '.bashrc': ''
+            }
+        })
+        with updated_env(HOME=os.path.abspath('home')):
+            with cd('pot'):
+                pot.install(jobs=4)
+        # inclusions into the same file keep order of configuration file
+        expected = ''.join('. {}\n'.format(os.path.abspath(os.path.join('pot/dotfiles', name))) for name in names)
+        eq_(open('home/.bashrc').read(), expected)
+        ok_(pot.same_file_symlink('home/.vimrc', 'pot/dotfiles/.vimrc'))
+        ok_(os.path.isdir('home/.vim/colors'))
+    # tasks following failed one aren't started, like in the serial run
+    failing = threading.Event()
+    ran = []
+
+    def wait():
+        failing.wait(5)
+        time.sleep(0.1)
+        ran.append(0)
+
+    def fail():
+        failing.set()
+        raise ValueError('failed')
+
+    try:
+        pot.run_in_order([('/b', wait), ('/a', fail), ('/b', lambda: ran.append(2))], 2)
+        ok_(False, 'error is not re-raised')
+    except ValueError:
+        pass
+    eq_(ran, [0])
+
+
+def test_parallel_install_nested():
+    links = ['.config/app{}'.format(i) for i in range(20)]
+    copies = ['.local/share/app{}'.format(i) for i in range(20)]
+    config = Config([DotFile(name) for name in links] + [DotFile(name, action='copy') for name in copies])
+    for _ in range(5):
+        with temp_cwd(prefix='pot-test'):
+            make_hierarchy({
+                'pot': {
+                    'dotfiles': {
+                        '.config': dict((os.path.basename(name), '') for name in links),
+                        '.local': {'share': dict((os.path.basename(name), '') for name in copies)}
+                    },
+                    'config.yaml': config.to_yaml()
+                },
+                'home': {}
+            })
+            # siblings in different chains create the same missing parent concurrently
+            plan = pot.PotRepo('pot').install(home='home', jobs=64)
+            ok_(all(op.kind != 'fail' for op in plan))
+            for name in links:
+                ok_(pot.same_file_symlink(os.path.join('home', name), os.path.join('pot/dotfiles', name)))
+            for name in copies:
+                ok_(os.path.isfile(os.path.join('home', name)))
+
+
+def test_incremental_install():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'pot': {
+                'dotfiles': {
+                    '.vimrc': '',
+                    '.vim': {'colors': {'x.vim': 'colorscheme'}}
+                },
+                'config.yaml': Config([DotFile('.vimrc'), DotFile('.vim', action='copy')]).to_yaml()
+            },
+            'home': {}
+        })
+        with updated_env(HOME=os.path.abspath('home')):
+            with cd('pot'):
+                pot.install()
+                ok_(os.path.exists(pot.MANIFEST_NAME))
+                link_inode = os.lstat('../home/.vimrc').st_ino
+                copy_inode = os.lstat('../home/.vim').st_ino
+                pot.install()
+                # up to date dotfiles are left as is
+                eq_(os.lstat('../home/.vimrc').st_ino, link_inode)
+                eq_(os.lstat('../home/.vim').st_ino, copy_inode)
+                # files edited inside copied directory are noticed and repaired too
+                with open('../home/.vim/colors/x.vim', 'w') as fd:
+                    fd.write('edited')
+                eq_([op.kind for op in pot.PotRepo('.').plan()], ['skip', 'sync'])
+                pot.install()
+                eq_(open('../home/.vim/colors/x.vim').read(), 'colorscheme')
+                eq_([op.kind for op in pot.PotRepo('.').plan()], ['skip', 'skip'])
+                os.remove('../home/.vimrc')
+                pot.install()
+                ok_(pot.same_file_symlink('../home/.vimrc', 'dotfiles/.vimrc'))
+                # removed source isn't hidden by the manifest
+                os.remove('dotfiles/.vimrc')
+                eq_([op.kind for op in pot.PotRepo('.').plan()], ['fail', 'skip'])
+
+
+def test_sync_tree():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'src': {
+                'plugin': {'a.vim': 'a', 'b.vim': 'b'},
+                'vimrc': 'set nocompatible\n'
+            }
+        })
+        pot.sync_tree('src', 'dst')
+        eq_(open('dst/plugin/a.vim').read(), 'a')
+        untouched_inode = os.lstat('dst/vimrc').st_ino
+        changed_inode = os.lstat('dst/plugin/a.vim').st_ino
+        with open('src/plugin/a.vim', 'w') as fd:
+            fd.write('changed')
+        os.remove('src/plugin/b.vim')
+        pot.sync_tree('src', 'dst')
+        eq_(open('dst/plugin/a.vim').read(), 'changed')
+        ok_(not os.path.exists('dst/plugin/b.vim'))
+        eq_(os.lstat('dst/vimrc').st_ino, untouched_inode)
+        ok_(os.lstat('dst/plugin/a.vim').st_ino != changed_inode)
+
+
+def test_update():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'upstream': {
+                '.vimrc': '',
+                '.vim': {'vimrc': '1'},
+            },
+            'pot': {
+                'config.yaml': Config([DotFile('.vimrc'), DotFile('.vim', action='copy')]).to_yaml()
+            },
+            'home': {}
+        })
+        # failures are reported through exit status
+        with cd('home'):
+            eq_(pot.update(), False)
+        with cd('pot'):
+            eq_(pot.update(), False)
+        with cd('upstream'):
+            git('init', '-q')
+            git('add', '.')
+            git('commit', '-q', '-m', 'initial')
+        git('clone', '-q', 'upstream', 'pot/dotfiles')
+        with updated_env(HOME=os.path.abspath('home')):
+            with cd('pot'):
+                pot.install()
+            with cd('upstream'):
+                with open('.vim/vimrc', 'w') as fd:
+                    fd.write('2')
+                git('commit', '-q', '-a', '-m', 'changed')
+            with assert_not_modified('home/.vimrc'):
+                with cd('pot'):
+                    eq_([df.name for df in pot.affected_dotfiles(
+                        [DotFile('.vimrc'), DotFile('.vim')], ['.vim/vimrc'])], ['.vim'])
+                    pot.update()
+        eq_(open('home/.vim/vimrc').read(), '2')
+        # both paths of renamed file are reported
+        with cd('upstream'):
+            git('mv', '.vimrc', '.exrc')
+            git('commit', '-q', '-m', 'renamed')
+        eq_(sorted(pot.pull_git_repo('pot')), ['.exrc', '.vimrc'])
+        # failed reinstallation is reported through exit status too
+        with open('pot/config.yaml', 'w') as fd:
+            Config([DotFile('.zshrc')]).to_yaml(fd)
+        make_hierarchy({'upstream/.zshrc': 'new', 'home/.zshrc': 'existing'})
+        with cd('upstream'):
+            git('add', '.zshrc')
+            git('commit', '-q', '-m', 'added')
+        with updated_env(HOME=os.path.abspath('home')):
+            with cd('pot'):
+                eq_(pot.update(), False)
+        eq_(open('home/.zshrc').read(), 'existing')
+
+
+def test_clone_from_mirror():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'upstream': {
+                '.vimrc': ''
+            },
+            'pot': {},
+            'mirrors': {}
+        })
+        with cd('upstream'):
+            git('init', '-q')
+            git('add', '.')
+            git('commit', '-q', '-m', 'initial')
+        git('clone', '-q', '--bare', 'upstream', 'upstream.git')
+        url = 'file://' + os.path.abspath('upstream.git')
+        head = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd='upstream').decode('utf-8').strip()
+        trace = os.path.abspath('trace')
+        with cd('pot'), updated_env(GIT_TRACE_PACKET=trace):
+            pot.clone_git_repo(url, depth=1, mirror='../mirrors')
+        ok_(os.path.isdir(pot.mirror_path('mirrors', url)))
+        ok_(os.path.exists('pot/dotfiles/.vimrc'))
+        # objects are taken from the mirror instead of being fetched again
+        with open(trace) as fd:
+            ok_('have ' + head in fd.read())
+        # and copied, so the clone survives removal of the mirror
+        ok_(not os.path.exists('pot/dotfiles/.git/objects/info/alternates'))
+        shutil.rmtree('mirrors')
+        with cd('pot/dotfiles'):
+            git('fsck')
+        # concurrent clones share the mirror
+        threads = [threading.Thread(target=pot.clone_git_repo, args=(url,),
+                                    kwargs={'mirror': 'mirrors', 'repo': 'pot{}'.format(i)}) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(4):
+            ok_(os.path.exists('pot{}/dotfiles/.vimrc'.format(i)))
+        # no temporary clones are left
+        mirror_name = os.path.basename(pot.mirror_path('mirrors', url))
+        eq_(sorted(os.listdir('mirrors')), [mirror_name, mirror_name + '.lock'])
+        # submodules are cloned through mirrors of their own URLs
+        with cd('upstream'):
+            git('-c', 'protocol.file.allow=always', 'submodule', 'add', '-q', url, 'vim')
+            git('commit', '-q', '-m', 'submodule')
+        super_url = 'file://' + os.path.abspath('upstream')
+        with updated_env(GIT_CONFIG_COUNT='1', GIT_CONFIG_KEY_0='protocol.file.allow', GIT_CONFIG_VALUE_0='always'):
+            pot.clone_git_repo(super_url, mirror='mirrors', repo='super')
+        ok_(os.path.exists('super/dotfiles/vim/.vimrc'))
+        ok_(os.path.isdir(pot.mirror_path('mirrors', super_url)))
+        ok_(not os.path.exists('super/dotfiles/.git/modules/vim/objects/info/alternates'))
+
+
+def test_status():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'pot': {
+                'dotfiles': {
+                    '.vimrc': '',
+                    '.zshrc': '',
+                    '.bashrc': '',
+                    '.inputrc': '',
+                    '.vim': {}
+                },
+                'config.yaml': Config([DotFile('.vimrc'), DotFile('.zshrc'), DotFile('.inputrc'),
+                                       DotFile('.bashrc', action='include'),
+                                       DotFile('.vim', action='copy')]).to_yaml()
+            },
+            'home': {
+                '.zshrc': lambda x: os.symlink('not-exists', x),
+                '.inputrc': 'other file',
+                '.bashrc': ''
+            }
+        })
+        with updated_env(HOME=os.path.abspath('home')):
+            with cd('pot'):
+                pot.install(['.vimrc', '.bashrc'])
+                entries = pot.scan_targets([os.path.abspath('../home/' + name) for name in
+                                            ['.vimrc', '.zshrc', '.inputrc', '.bashrc', '.vim']])
+                manifest = pot.Manifest.load(pot.MANIFEST_NAME)
+                statuses = [pot.dotfile_status(df, os.path.abspath('dotfiles/' + df.name),
+                                               os.path.abspath('../home/' + df.name),
+                                               entries[os.path.abspath('../home/' + df.name)], manifest)
+                            for df in Config.load('config.yaml').dotfiles]
+                eq_(statuses, ['ok', 'broken', 'diverged', 'ok', 'missing'])
+                eq_(pot.status(), False)
+
+
+def test_batched_include():
+    names = ['.aliases', '.exports', '.functions']
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'pot': {
+                'dotfiles': dict((name, '') for name in names),
+                'config.yaml': Config([DotFile(name, target='~/.bashrc', action='include')
+                                       for name in names]).to_yaml()
+            },
+            'home': {
+                '.bashrc': 'export EDITOR=vim\n  . {}  \nalias ll="ls -l"'.format(
+                    os.path.abspath('pot/dotfiles/.exports'))
+            }
+        })
+        scanned = []
+        find_inclusions = pot.find_inclusions
+        pot.find_inclusions = lambda path, lines: scanned.append(path) or find_inclusions(path, lines)
+        try:
+            with updated_env(HOME=os.path.abspath('home')):
+                with cd('pot'):
+                    pot.install()
+        finally:
+            pot.find_inclusions = find_inclusions
+        # target scanned by planning isn't read again when lines are appended
+        eq_(scanned, [os.path.abspath('home/.bashrc')])
+        with updated_env(HOME=os.path.abspath('home')):
+            with cd('pot'):
+                manifest = pot.Manifest.load(pot.MANIFEST_NAME)
+                config = Config.load('config.yaml')
+                # all inclusions are recorded after the single append
+                ok_(all(manifest.is_current(df, os.path.abspath('dotfiles/' + df.name),
+                                            os.path.abspath('../home/.bashrc')) for df in config.dotfiles))
+        lines = open('home/.bashrc').read().splitlines()
+        eq_(lines[2:], ['alias ll="ls -l"'] + ['. {}'.format(os.path.abspath('pot/dotfiles/' + name))
+                                                for name in ['.aliases', '.functions']])
+
+
+def test_reconcile():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'pot': {
+                'dotfiles': {
+                    '.vimrc': '',
+                    '.zshrc': '',
+                    '.vim': {'vimrc': '1'}
+                },
+                'config.yaml': Config([DotFile('.vimrc'), DotFile('.vim', action='copy')]).to_yaml()
+            },
+            'home': {}
+        })
+        with updated_env(HOME=os.path.abspath('home')):
+            with cd('pot'):
+                pot.install()
+                config = Config.load('config.yaml')
+                with open('config.yaml', 'w') as fd:
+                    fd.write(Config([DotFile('.zshrc'), DotFile('.vim', action='copy')]).to_yaml())
+                with open('dotfiles/.vim/vimrc', 'w') as fd:
+                    fd.write('2')
+                config = pot.reconcile(config, {os.path.abspath('config.yaml'),
+                                                os.path.abspath('dotfiles/.vim/vimrc')})
+                eq_(config, Config([DotFile('.zshrc'), DotFile('.vim', action='copy')]))
+        ok_(not os.path.lexists('home/.vimrc'))
+        ok_(pot.same_file_symlink('home/.zshrc', 'pot/dotfiles/.zshrc'))
+        eq_(open('home/.vim/vimrc').read(), '2')
+        # templates are rendered again when variables in included file change
+        for path, content in [('pot/dotfiles/.gitconfig', 'email = {{ email }}'),
+                              ('pot/vars.yaml', 'variables: {email: me@example.com}'),
+                              ('pot/config.yaml', 'include: vars.yaml\ndotfiles: [{name: .gitconfig, action: template}]')]:
+            with open(path, 'w') as fd:
+                fd.write(content)
+        with updated_env(HOME=os.path.abspath('home')):
+            with cd('pot'):
+                config = pot.reconcile(config, {os.path.abspath('config.yaml')})
+                eq_(open('../home/.gitconfig').read(), 'email = me@example.com')
+                with open('vars.yaml', 'w') as fd:
+                    fd.write('variables: {email: me@example.org}')
+                pot.reconcile(config, {os.path.abspath('vars.yaml')})
+        eq_(open('home/.gitconfig').read(), 'email = me@example.org')
+
+
+@nottest
+def _test_watcher(watcher_class):
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'config.yaml': '',
+            'manifest.json': '',
+            'dotfiles': {
+                '.vim': {},
+                '.git': {'objects': {}}
+            }
+        })
+        watcher = watcher_class([(os.path.abspath('config.yaml'), False), (os.path.abspath('dotfiles'), True)])
+        try:
+            with open('manifest.json', 'w') as fd:
+                fd.write('ignored')
+            os.mkdir('dotfiles/.vim/colors')
+            with open('dotfiles/.vim/colors/dark.vim', 'w') as fd:
+                fd.write('new file')
+            with open('dotfiles/.git/objects/ab', 'w') as fd:
+                fd.write('ignored')
+            changed = pot.collect_changes(watcher, delay=0.2)
+            ok_(os.path.abspath('dotfiles/.vim/colors/dark.vim') in changed)
+            ok_(os.path.abspath('manifest.json') not in changed)
+            ok_(not [path for path in changed if '.git' in path.split(os.sep)])
+            with open('config.yaml', 'w') as fd:
+                fd.write('dotfiles: []')
+            ok_(os.path.abspath('config.yaml') in pot.collect_changes(watcher, delay=0.2))
+        finally:
+            watcher.close()
+        # file included by configuration may be inside of watched tree
+        make_hierarchy({'dotfiles/vars.yaml': '', 'dotfiles/.vimrc': ''})
+        watcher = watcher_class([(os.path.abspath('config.yaml'), False), (os.path.abspath('dotfiles'), True),
+                                 (os.path.abspath('dotfiles/vars.yaml'), False)])
+        try:
+            with open('dotfiles/.vimrc', 'w') as fd:
+                fd.write('changed')
+            ok_(os.path.abspath('dotfiles/.vimrc') in pot.collect_changes(watcher, delay=0.2))
+        finally:
+            watcher.close()
+
+
+def test_watchers():
+    yield _test_watcher, pot.InotifyWatcher
+    yield _test_watcher, lambda paths: pot.PollingWatcher(paths, interval=0.05)
+
+
 def test_grab():
     with temp_cwd(prefix='pot-test'):
         make_hierarchy({
@@ -300,9 +734,676 @@ def test_grab():
                 pot.grab('foo')
 
 
-if __name__ == '__main__':
-    nose.core.runmodule()
+def test_bulk_grab():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'home': {
+                '.pot': {
+                    'dotfiles': {
+                        '.vimrc': ''
+                    },
+                    'config.yaml': Config([DotFile('.vimrc')]).to_yaml()
+                },
+                '.bashrc': '',
+                '.bash_profile': '',
+                '.vim': {'vimrc': ''}
+            }
+        })
+        with updated_env(HOME=os.path.abspath('home'), POT_HOME=os.path.abspath('home/.pot')):
+            ok_(pot.grab(['~/.bash*', 'home/.vim']))
+            eq_(Config.load('home/.pot/config.yaml'),
+                Config([DotFile('.vimrc'), DotFile('.bash_profile'), DotFile('.bashrc'), DotFile('.vim')]))
+        for name in ['.bashrc', '.bash_profile', '.vim']:
+            ok_(pot.same_file_symlink(os.path.join('home', name), os.path.join('home/.pot/dotfiles', name)))
+        # files grabbed before are left as they are when pattern is grabbed again
+        with open('home/.bashrc') as fd:
+            bashrc = fd.read()
+        with updated_env(HOME=os.path.abspath('home'), POT_HOME=os.path.abspath('home/.pot')):
+            ok_(pot.grab(['~/.bash*'], force=True))
+        ok_(pot.same_file_symlink('home/.bashrc', 'home/.pot/dotfiles/.bashrc'))
+        with open('home/.bashrc') as fd:
+            eq_(fd.read(), bashrc)
+        eq_(len(Config.load('home/.pot/config.yaml').dotfiles), 4)
+        # files with the same name are refused instead of replacing each other
+        make_hierarchy({'home/.config': {'foo': {'config': 'foo'}, 'bar': {'config': 'bar'}}})
+        with updated_env(HOME=os.path.abspath('home'), POT_HOME=os.path.abspath('home/.pot')):
+            ok_(not pot.grab(['~/.config/*/config'], force=True))
+        ok_(not os.path.lexists('home/.pot/dotfiles/config'))
+        for name in ['foo', 'bar']:
+            with open(os.path.join('home/.config', name, 'config')) as fd:
+                eq_(fd.read(), name)
+        try:
+            pot.register_dotfiles('home/.pot/config.yaml', [DotFile('config'), DotFile('config', '~/.config')])
+            ok_(False, 'dotfiles with the same name are registered')
+        except ValueError:
+            pass
 
 
+def test_profiler():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'pot': {
+                'dotfiles': {'.vimrc': ''},
+                'config.yaml': Config([DotFile('.vimrc')]).to_yaml()
+            },
+            'home': {}
+        })
+        pot.profiler = pot.Profiler()
+        try:
+            with updated_env(HOME=os.path.abspath('home')):
+                with cd('pot'):
+                    pot.install()
+            phases = [row[0] for row in pot.profiler.summary()]
+            ok_('config.parse' in phases)
+            ok_('install.symlink' in phases)
+            pot.profiler.write_trace('trace.json')
+            with open('trace.json') as fd:
+                events = json.load(fd)['traceEvents']
+            eq_(len(events), len(pot.profiler.events))
+        finally:
+            pot.profiler = None
+
+
+def test_complete():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'config.yaml': Config([DotFile('.vimrc'), DotFile('.vim'), DotFile('.bashrc')]).to_yaml()
+        })
+        output = io.StringIO()
+        with redirect_stdout(output):
+            pot.complete(['install', '.vim', '.v'])
+            pot.complete(['-v', 'ins'])
+        eq_(output.getvalue().split(), ['.vimrc', '.vim', 'install'])
+        ok_(os.path.exists(pot.NAMES_INDEX_NAME))
+
+
+def test_plan():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'pot': {
+                'dotfiles': {
+                    '.vimrc': '',
+                    '.zshrc': '',
+                    '.inputrc': '',
+                    '.bashrc': '',
+                },
+                'config.yaml': Config([DotFile('.vimrc'), DotFile('.zshrc'), DotFile('.inputrc'),
+                                       DotFile('.bashrc', action='include'), DotFile('.missing')]).to_yaml()
+            },
+            'home': {
+                '.zshrc': lambda x: os.symlink('not-exists', x),
+                '.inputrc': 'other file',
+                '.bashrc': ''
+            }
+        })
+        with updated_env(HOME=os.path.abspath('home')):
+            with cd('pot'):
+                pot.install(['.vimrc'])
+                config = Config.load('config.yaml')
+                plan = pot.plan_install(['.vimrc', '.zshrc', '.inputrc', '.bashrc', '.missing', '.unknown', '.zshrc'],
+                                        {df.name: df for df in config.dotfiles}, pot.Manifest.load(pot.MANIFEST_NAME))
+                eq_([(op.kind, op.remove) for op in plan],
+                    [('skip', False), ('link', True), ('fail', False), ('include', False), ('fail', False),
+                     ('fail', False)])
+                # dry run doesn't touch anything
+                pot.install(dry_run=True)
+                ok_(pot.broken_link('../home/.zshrc'))
+
+
+def test_install_roots():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'pot': {
+                'dotfiles': {
+                    '.vimrc': '',
+                    '.bashrc': '',
+                    'rc.conf': ''
+                },
+                'config.yaml': Config([DotFile('.vimrc'), DotFile('.bashrc', action='include'),
+                                       DotFile('rc.conf', target='.config/rc.conf', action='copy')]).to_yaml()
+            },
+            'homes': {
+                'alice': {'.bashrc': ''},
+                'bob': {'.bashrc': ''}
+            }
+        })
+        with cd('pot'):
+            # dry run only prints plans
+            with redirect_stdout(io.StringIO()) as stdout:
+                ok_(pot.install_roots(['../homes/alice', '../homes/bob'], jobs=2, dry_run=True))
+            ok_(not os.path.lexists('../homes/alice/.vimrc'))
+            ok_('link     .vimrc -> {}'.format(os.path.abspath('../homes/bob/.vimrc')) in stdout.getvalue())
+            ok_(pot.install_roots(['../homes/alice', '../homes/bob'], jobs=2))
+        for home in ['homes/alice', 'homes/bob']:
+            ok_(pot.same_file_symlink(os.path.join(home, '.vimrc'), 'pot/dotfiles/.vimrc'))
+            ok_(os.path.isfile(os.path.join(home, '.config/rc.conf')))
+            eq_(open(os.path.join(home, '.bashrc')).read(), '. {}\n'.format(os.path.abspath('pot/dotfiles/.bashrc')))
+        # every root has its own manifest
+        eq_(len(os.listdir(os.path.join('pot', pot.MANIFESTS_DIR))), 2)
+        # patterns matching no directories are reported
+        args = argparse.Namespace(dotfiles=[], from_bundle=None, root=[], force=False, full=False, jobs=1,
+                                  profile=None, dry_run=True)
+        with redirect_stdout(io.StringIO()), cd('pot'):
+            args.homes = ['../homes/*', '../homs/*']
+            eq_(pot.install_command_handler(args), False)
+            args.homes = ['../homes/*']
+            eq_(pot.install_command_handler(args), True)
+        eq_(pot.expand_target('~/.vimrc', '/home/alice'), '/home/alice/.vimrc')
+        eq_(pot.expand_target('.config/rc.conf', '/home/alice'), '/home/alice/.config/rc.conf')
+
+
+def test_repo_session():
+    from concurrent.futures import ThreadPoolExecutor
+    with temp_cwd(prefix='pot-test') as root:
+        make_hierarchy({
+            'pot': {
+                'dotfiles': {'.vimrc': '', 'rc.conf': ''},
+                'config.yaml': Config([DotFile('.vimrc'),
+                                       DotFile('rc.conf', target='.config/rc.conf', action='copy')]).to_yaml()
+            },
+            'homes': {'alice': {}, 'bob': {}}
+        })
+        cwd = os.getcwd()
+        repo = pot.PotRepo(os.path.join(root, 'pot'))
+        homes = [os.path.join(root, 'homes', name) for name in ('alice', 'bob')]
+        with ThreadPoolExecutor(4) as executor:
+            plans = list(executor.map(lambda home: repo.install(home=home), homes * 2))
+        eq_(os.getcwd(), cwd)
+        eq_(len(plans), 4)
+        for home in homes:
+            ok_(pot.same_file_symlink(os.path.join(home, '.vimrc'), os.path.join(root, 'pot/dotfiles/.vimrc')))
+            eq_([state for _, _, state in repo.status(home=home)], ['ok', 'ok'])
+
+
+def test_template():
+    with temp_cwd(prefix='pot-test'):
+        hostname = os.uname()[1]
+        make_hierarchy({
+            'dotfiles': {'.gitconfig': '[user]\n  email = {{ git.email }}\n  host = {{hostname}}\n'},
+            'home': {}
+        })
+        config = Config([DotFile('.gitconfig', target='home/.gitconfig', action='template')],
+                        variables={'git': {'email': 'me@example.com'}})
+        eq_(Config.from_yaml(config.to_yaml()).variables, config.variables)
+        target = os.path.abspath('home/.gitconfig')
+
+        def plan():
+            manifest = pot.Manifest.load(pot.MANIFEST_NAME)
+            variables = config.template_variables()
+            return pot.plan_install(['.gitconfig'], {'.gitconfig': config.dotfiles[0]}, manifest,
+                                    variables=variables), manifest
+
+        pot.apply_plan(*plan())
+        eq_(open(target).read(), '[user]\n  email = me@example.com\n  host = {}\n'.format(hostname))
+        # nothing is rendered again until template or its variables change
+        eq_([op.kind for op in plan()[0]], ['skip'])
+        with assert_not_modified(target):
+            os.utime('dotfiles/.gitconfig')
+            operations, manifest = plan()
+            eq_([op.kind for op in operations], ['skip'])
+            pot.apply_plan(operations, manifest)
+        config.hosts = {hostname: {'git': {'email': 'work@example.com'}}}
+        eq_([op.kind for op in plan()[0]], ['render'])
+        pot.apply_plan(*plan())
+        ok_('work@example.com' in open(target).read())
+        eq_(pot.dotfile_status(config.dotfiles[0], os.path.abspath('dotfiles/.gitconfig'), target,
+                               pot.scan_targets([target])[target], pot.Manifest.load(pot.MANIFEST_NAME)), 'ok')
+        try:
+            pot.render_template('{{ undefined }}', {})
+            ok_(False, 'undefined variable is not reported')
+        except ValueError:
+            pass
+        # user of explicit home is its owner rather than the one running pot
+        import pwd
+        with updated_env(USER='somebody'):
+            eq_(pot.host_variables('.')['user'], pwd.getpwuid(os.getuid()).pw_name)
+
+
+def test_profiles():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'config.yaml': """\
+include: base.yaml
+dotfiles:
+- {name: .vimrc}
+profiles:
+  dev:
+    include: dev.yaml
+    dotfiles:
+    - {name: .bashrc, action: include}
+  ci:
+    extends: dev
+    exclude: [.vimrc]
+    variables: {git: {email: ci@example.com}}
+""",
+            'base.yaml': 'dotfiles: [{name: .bashrc}]\nvariables: {git: {name: me, email: me@example.com}}',
+            'dev.yaml': 'dotfiles: [{name: .gitconfig, action: template}]'
+        })
+        eq_(Config.load('config.yaml'), Config([DotFile('.bashrc'), DotFile('.vimrc')]))
+        dev = Config([DotFile('.bashrc', action='include'), DotFile('.vimrc'),
+                      DotFile('.gitconfig', action='template')])
+        eq_(Config.load('config.yaml', 'dev'), dev)
+        ci = Config.load('config.yaml', 'ci')
+        eq_(ci, Config([DotFile('.bashrc', action='include'), DotFile('.gitconfig', action='template')]))
+        eq_(ci.variables, {'git': {'name': 'me', 'email': 'ci@example.com'}})
+        ok_(os.path.exists(pot.CONFIG_CACHE_NAME + '.ci'))
+        # cache of profile is invalidated by change of any included file
+        with open('dev.yaml', 'w') as fd:
+            fd.write('dotfiles: [{name: .gitconfig, action: copy}]')
+        eq_(Config.load('config.yaml', 'dev'), Config(dev.dotfiles[:2] + [DotFile('.gitconfig', action='copy')]))
+        try:
+            Config.load('config.yaml', 'unknown')
+            ok_(False, 'unknown profile is not reported')
+        except ValueError:
+            pass
+        # profile name becomes part of the cache file name
+        for name in ['../ci', 'ci/dev', '..']:
+            try:
+                Config.load('config.yaml', name)
+                ok_(False, 'invalid profile name {!r} is accepted'.format(name))
+            except ValueError:
+                pass
+        # watch reinstalls dotfiles of the profile only
+        make_hierarchy({'dotfiles': {'.vimrc': '', '.bashrc': '', '.gitconfig': ''}, 'home': {'.bashrc': ''}})
+        with updated_env(HOME=os.path.abspath('home')):
+            pot.reconcile(Config([]), {None}, profile='ci')
+        eq_(sorted(os.listdir('home')), ['.bashrc', '.gitconfig'])
+        # exclude of the main file survives rewrite of it
+        make_hierarchy({'top.yaml': 'include: base.yaml\nexclude: [.bashrc]\ndotfiles: []'})
+        pot.register_dotfiles('top.yaml', [DotFile('.inputrc')])
+        eq_(Config.load('top.yaml'), Config([DotFile('.inputrc')]))
+        # unless the excluded dotfile is grabbed
+        pot.register_dotfiles('top.yaml', [DotFile('.bashrc')])
+        eq_(Config.load('top.yaml'), Config([DotFile('.inputrc'), DotFile('.bashrc')]))
+        # partial overrides of included dotfiles stay partial
+        make_hierarchy({'copy.yaml': 'dotfiles: [{name: .x, action: copy}]',
+                        'override.yaml': 'include: copy.yaml\ndotfiles:\n- {name: .x, target: ~/.y}\n'})
+        pot.register_dotfiles('override.yaml', [DotFile('.inputrc')])
+        eq_(Config.load('override.yaml'), Config([DotFile('.x', '~/.y', 'copy'), DotFile('.inputrc')]))
+
+
+def test_object_store():
+    with temp_cwd(prefix='pot-test'):
+        font = b'glyph' * pot.STORE_MIN_SIZE
+        make_hierarchy({'team1': {'font.ttf': '', 'small': 'x'}, 'team2': {'fonts': {'font.ttf': ''}}, 'home': {}})
+        for path in ['team1/font.ttf', 'team2/fonts/font.ttf']:
+            with open(path, 'wb') as fd:
+                fd.write(font)
+        store = pot.ObjectStore(os.path.abspath('objects'))
+        eq_(store.dedupe('team1'), len(font))
+        eq_(store.dedupe('team2'), len(font))
+        ok_(os.path.samefile('team1/font.ttf', 'team2/fonts/font.ttf'))
+        eq_(os.stat('team1/small').st_nlink, 1)
+        # stored objects can't be modified through hardlinks
+        eq_(os.stat('team1/font.ttf').st_mode & 0o222, 0)
+        store.save()
+        store = pot.ObjectStore(os.path.abspath('objects'))
+        pot.sync_tree('team2', 'home/team2', store)
+        # deduplicated source is found in the index without reading it
+        ok_(not store.modified)
+        eq_(open('home/team2/fonts/font.ttf', 'rb').read(), font)
+        ok_(os.access('home/team2/fonts/font.ttf', os.W_OK))
+        pot.render_file('team1/font.ttf', 'home/font.ttf', {})
+        ok_(os.stat('home/font.ttf').st_mode & stat.S_IWUSR)
+        eq_(pot.ObjectStore(os.path.abspath('objects')).dedupe('team1'), 0)
+        # files modified just now may change within the same mtime tick, their digests aren't kept
+        make_hierarchy({'fresh': 'content'})
+        store = pot.ObjectStore(os.path.abspath('objects'))
+        eq_(store.digest('fresh', os.stat('fresh')), pot.file_digest('fresh'))
+        ok_(not store.modified)
+        # init links only sources of copied dotfiles to the store shared by repositories
+        for repo in ['repo', 'repo2']:
+            make_hierarchy({repo: {'dotfiles': {}, 'config.yaml': Config([
+                DotFile('font.ttf', action='copy'), DotFile('.big')]).to_yaml()}})
+            for path in [repo + '/dotfiles/font.ttf', repo + '/dotfiles/.big']:
+                with open(path, 'wb') as fd:
+                    fd.write(font)
+        with updated_env(POT_HOME=os.path.abspath('pot')):
+            pot.init('repo', store=True)
+            eq_(os.stat('repo/dotfiles/font.ttf').st_nlink, 2)
+            eq_(os.stat('repo/dotfiles/.big').st_nlink, 1)
+            ok_(os.stat('repo/dotfiles/.big').st_mode & stat.S_IWUSR)
+            pot.init('repo2', store=True)
+            ok_(os.path.samefile('repo/dotfiles/font.ttf', 'repo2/dotfiles/font.ttf'))
+            # entries of the files replaced by links are pruned, only the object is left
+            store = pot.ObjectStore.for_repo(os.path.abspath('repo'))
+            eq_(store.path, os.path.abspath('pot/objects'))
+            eq_([entry[3] for entry in store.index.values()],
+                [store.object_path(pot.file_digest('repo/dotfiles/.big'))])
 
 
+def test_hash_cache():
+    import hashlib
+
+    with temp_cwd(prefix='pot-test'):
+        blob = os.urandom(pot.MMAP_MIN_SIZE + 12345)
+        make_hierarchy({'tree': {'blob': '', 'small': 'small', 'empty': ''}})
+        with open('tree/blob', 'wb') as fd:
+            fd.write(blob)
+        eq_(pot.file_digest('tree/blob'), hashlib.sha1(blob).hexdigest())
+        eq_(pot.file_digest('tree/empty'), hashlib.sha1(b'').hexdigest())
+        # pretend files are old enough to be cached
+        for name in os.listdir('tree'):
+            os.utime(os.path.join('tree', name), (time.time() - 10, time.time() - 10))
+        digest = pot.content_digest('tree')
+        cache = pot.HashCache('hashes.json')
+        eq_(pot.content_digest('tree', cache), digest)
+        cache.save()
+        file_digest = pot.file_digest
+        pot.file_digest = None
+        try:
+            # files are not read again by the next run
+            eq_(pot.content_digest('tree', pot.HashCache('hashes.json')), digest)
+        finally:
+            pot.file_digest = file_digest
+        with open('tree/small', 'w') as fd:
+            fd.write('changed')
+        ok_(pot.content_digest('tree', pot.HashCache('hashes.json')) != digest)
+
+
+def test_init_discovery():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'dotfiles': {
+                '.git': {'config': ''},
+                '.gitignore': '*.bak\n!.keep.bak\n/.cache/\n',
+                '.gitmodules': '',
+                '.vimrc': '',
+                '.vimrc.bak': '',
+                '.keep.bak': '',
+                '.cache': {},
+                'README.md': '',
+                '.config': {
+                    '.potignore': 'secret\n',
+                    'nvim': {'init.vim': ''},
+                    'secret': ''
+                },
+                '.local': {'share': {'fonts': {}}}
+            }
+        })
+        pot.init('.')
+        names = [df.name for df in Config.load('config.yaml').dotfiles]
+        eq_(sorted(names), ['.config/nvim', '.keep.bak', '.local/share/fonts', '.vimrc'])
+        eq_(Config.load('config.yaml').dotfiles[0].target, '~/.config/nvim')
+        # existing entries are kept, new ones are appended
+        with open('config.yaml') as fd:
+            config = Config.from_yaml(fd)
+        config.dotfiles[0].action = 'copy'
+        with open('config.yaml', 'w') as fd:
+            config.to_yaml(fd)
+        with assert_not_modified('config.yaml'):
+            pot.init('.')
+        make_hierarchy({'dotfiles/.inputrc': ''})
+        pot.init('.')
+        with open('config.yaml') as fd:
+            config = Config.from_yaml(fd)
+        eq_([df.name for df in config.dotfiles], names + ['.inputrc'])
+        eq_(config.dotfiles[0].action, 'copy')
+        # parents of nested targets are created in empty home
+        make_hierarchy({'home': {}})
+        plan = pot.PotRepo('.').install(home='home')
+        eq_(set(op.kind for op in plan), {'sync', 'link'})
+        ok_(os.path.isfile('home/.config/nvim/init.vim'))
+        ok_(pot.same_file_symlink('home/.local/share/fonts', 'dotfiles/.local/share/fonts'))
+        ok_(pot.same_file_symlink('home/.vimrc', 'dotfiles/.vimrc'))
+        # entries are written back without defaults of omitted fields
+        with open('config.yaml', 'w') as fd:
+            fd.write('dotfiles:\n- {name: .vimrc, target: ~/.vim/vimrc}\n')
+        pot.init('.')
+        with open('config.yaml') as fd:
+            ok_('action' not in fd.read().split('\n- ')[1])
+
+
+def test_bundle():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'pot': {
+                'dotfiles': {
+                    '.vimrc': 'set nocompatible',
+                    '.bashrc': 'alias ll="ls -l"',
+                    '.vim': {'colors': {'dark.vim': 'hi Normal'}},
+                    '.gitconfig': 'email = {{ email }}'
+                },
+                'config.yaml': Config([DotFile('.vimrc'), DotFile('.bashrc', action='include'),
+                                       DotFile('.vim', action='copy'),
+                                       DotFile('.gitconfig', action='template')],
+                                      variables={'email': 'me@example.com'},
+                                      hooks={'post_install': 'true'}).to_yaml()
+            },
+            'target': {},
+            'home': {'.bashrc': '# user settings\n'},
+            'home2': {'.bashrc': ''}
+        })
+        bundle_path = os.path.abspath('dots.tar.xz')
+        home = os.path.abspath('home')
+        # like sources linked to the object store
+        for path in ['pot/dotfiles/.vim/colors/dark.vim', 'pot/dotfiles/.gitconfig']:
+            os.chmod(path, 0o444)
+        ok_(pot.PotRepo('pot').bundle(bundle_path))
+        repo = pot.PotRepo('target')
+        ok_(repo.install_bundle(bundle_path, home=home))
+        ok_(pot.same_file_symlink('home/.vimrc', 'target/dotfiles/.vimrc'))
+        ok_(pot.has_inclusion('home/.bashrc', '. ' + os.path.abspath('target/dotfiles/.bashrc')))
+        eq_(open('home/.vim/colors/dark.vim').read(), 'hi Normal')
+        eq_(open('home/.gitconfig').read(), 'email = me@example.com')
+        ok_(all(os.stat(path).st_mode & stat.S_IWUSR for path in ['home/.vim/colors/dark.vim', 'home/.gitconfig']))
+        # sources of copied dotfiles aren't extracted
+        ok_(not os.path.exists('target/dotfiles/.vim'))
+        eq_(repo.config, Config.load('pot/config.yaml'))
+        eq_(repo.config.hooks, {'post_install': ['true']})
+        # manifest written from bundle makes the next installation a no-op
+        eq_([op.kind for op in repo.plan(home=home)], ['skip'] * 4)
+        eq_([state for _, _, state in repo.status(home=home)], ['ok'] * 4)
+        try:
+            repo.install_bundle(bundle_path, home=home)
+            ok_(False, 'existing configuration is overwritten')
+        except ValueError:
+            pass
+        # removed source of ordinary copy is still reported
+        home = os.path.abspath('home2')
+        repo = pot.PotRepo('pot')
+        repo.install(home=home)
+        os.remove('pot/dotfiles/.gitconfig')
+        eq_([op.kind for op in repo.plan(home=home)], ['skip', 'skip', 'skip', 'fail'])
+        eq_([state for _, _, state in repo.status(home=home)], ['ok', 'ok', 'ok', 'broken'])
+
+
+def test_bundle_extraction():
+    import tarfile
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({'target': {}, 'outside': {}, 'home': {'.ssh': {'keep': ''}}})
+        dotfiles = [{'name': '.vim', 'target': '~/.vim', 'action': 'copy', 'digest': ''},
+                    {'name': '.ssh', 'target': '~/.ssh', 'action': 'copy', 'digest': ''},
+                    {'name': '.zshrc', 'target': '~/.zshrc', 'action': 'symlink'},
+                    {'name': '.config/fish', 'target': '~/.config/fish', 'action': 'symlink'}]
+        with tarfile.open('evil.tar', 'w') as tar:
+            pot.add_bundle_member(tar, pot.BUNDLE_INDEX_NAME, json.dumps(
+                {'version': pot.BUNDLE_VERSION, 'profile': None, 'dotfiles': dotfiles}).encode('utf-8'))
+            pot.add_bundle_member(tar, 'config.yaml', Config([DotFile(df['name'], action=df['action'])
+                                                              for df in dotfiles]).to_yaml().encode('utf-8'))
+            for name, kind, linkname in [('.vim', tarfile.DIRTYPE, ''), ('.vim/up', tarfile.SYMTYPE, '../../outside'),
+                                         ('.vim/up/passwd', tarfile.REGTYPE, ''), ('.ssh', tarfile.SYMTYPE, '/etc'),
+                                         ('.vim/up/passwd', tarfile.REGTYPE, ''), ('../passwd', tarfile.REGTYPE, '')]:
+                info = tarfile.TarInfo('dotfiles/' + name)
+                info.type, info.linkname, info.mode = kind, linkname, 0o755
+                tar.addfile(info)
+            pot.add_bundle_member(tar, 'dotfiles/.zshrc', b'')
+            pot.add_bundle_member(tar, 'dotfiles/.config/fish', b'')
+        ok_(not pot.PotRepo('target').install_bundle('evil.tar', force=True, home=os.path.abspath('home')))
+        eq_(os.listdir('outside'), [])
+        ok_(not os.path.lexists('home/.vim/up') and not os.path.lexists('passwd'))
+        # rejected dotfile doesn't replace existing target
+        ok_(os.path.exists('home/.ssh/keep'))
+        ok_(pot.same_file_symlink('home/.zshrc', 'target/dotfiles/.zshrc'))
+        ok_(pot.same_file_symlink('home/.config/fish', 'target/dotfiles/.config/fish'))
+
+
+def test_events():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'pot': {
+                'dotfiles': {'.vimrc': '', '.inputrc': 'set editing-mode vi'},
+                'config.yaml': Config([DotFile('.vimrc'), DotFile('.inputrc', action='copy'),
+                                       DotFile('.missing')]).to_yaml()
+            },
+            'home': {}
+        })
+        stream = io.StringIO()
+        pot.events = pot.EventStream(stream)
+        try:
+            pot.PotRepo('pot').install(home='home')
+            pot.PotRepo('pot').install(home='home')
+            pot.events.flush()
+        finally:
+            pot.events = None
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        eq_([(r['dotfile'], r['action'], r['outcome']) for r in records], [
+            ('.vimrc', 'link', 'ok'), ('.inputrc', 'sync', 'ok'), ('.missing', 'fail', 'failed'),
+            ('.vimrc', 'skip', 'skipped'), ('.inputrc', 'skip', 'skipped'), ('.missing', 'fail', 'failed')
+        ])
+        eq_(records[1]['bytes'], len('set editing-mode vi'))
+        eq_(records[1]['target'], os.path.abspath('home/.inputrc'))
+        ok_(all(r['event'] == 'install' and r['duration'] >= 0 for r in records))
+    # quiet mode doesn't even format descriptions of actions
+    handler = logging.handlers.BufferingHandler(100)
+    pot.logger.addHandler(handler)
+    pot._quiet_mode = True
+    try:
+        with pot.report_action('{} {}', 'missing argument'):
+            pass
+    finally:
+        pot._quiet_mode = False
+        pot.logger.removeHandler(handler)
+    eq_(handler.buffer, [])
+    # plan and status don't get mixed with events streamed to stdout
+    with redirect_stdout(io.StringIO()) as stdout, redirect_stderr(io.StringIO()) as stderr:
+        pot.events = pot.EventStream(sys.stdout)
+        try:
+            pot.print_result('ok')
+        finally:
+            pot.events = None
+    eq_((stdout.getvalue(), stderr.getvalue()), ('', 'ok\n'))
+    # events written to file imply quiet mode as well
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'pot': {'dotfiles': {'.vimrc': ''}, 'config.yaml': Config([DotFile('.vimrc')]).to_yaml()},
+            'home': {}
+        })
+        output = subprocess.check_output([sys.executable, pot.__file__, '--events', '../events.jsonl', 'install'],
+                                         cwd='pot', env=dict(os.environ, HOME=os.path.abspath('home')))
+        eq_(output, b'')
+        with open('events.jsonl') as fd:
+            eq_([json.loads(line)['dotfile'] for line in fd], ['.vimrc'])
+
+
+def test_repo_lock():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'pot': {
+                'dotfiles': {'.vimrc': ''},
+                'config.yaml': Config([DotFile('.vimrc')]).to_yaml()
+            },
+            'home': {}
+        })
+        repo = pot.PotRepo('pot')
+        results = []
+        reader = threading.Thread(target=lambda: results.append(pot.PotRepo('pot').status(home='home')))
+        with repo.lock(exclusive=True):
+            reader.start()
+            reader.join(0.2)
+            # status waits for the writer to release the repository
+            ok_(reader.is_alive())
+            eq_(results, [])
+        reader.join(5)
+        eq_([state for _, _, state in results[0]], ['missing'])
+        # rewritten files keep their permissions
+        os.chmod('pot/config.yaml', 0o600)
+        with pot.atomic_write('pot/config.yaml') as fd:
+            fd.write(Config([]).to_yaml())
+        eq_(os.stat('pot/config.yaml').st_mode & 0o777, 0o600)
+        # symlinked config.yaml is written through, the link is kept
+        make_hierarchy({'shared': {'config.yaml': Config([DotFile('.vimrc')]).to_yaml()}, 'home/.zshrc': ''})
+        os.remove('pot/config.yaml')
+        os.symlink('../shared/config.yaml', 'pot/config.yaml')
+        with updated_env(HOME=os.path.abspath('home'), POT_HOME=os.path.abspath('pot')):
+            ok_(pot.grab(['home/.zshrc']))
+        ok_(os.path.islink('pot/config.yaml'))
+        eq_(os.listdir('shared'), ['config.yaml'])
+        eq_(Config.load('shared/config.yaml'), Config([DotFile('.vimrc'), DotFile('.zshrc')]))
+
+
+def test_hooks():
+    with temp_cwd(prefix='pot-test'):
+        make_hierarchy({
+            'pot': {
+                'dotfiles': {'.vimrc': '', '.zshrc': '', '.inputrc': ''},
+                'config.yaml': Config([
+                    DotFile('.vimrc', pre_install='echo "pre $POT_DOTFILE" >> ../../log',
+                            post_install=['echo "post $POT_DOTFILE" >> ../../log', 'echo done']),
+                    DotFile('.zshrc', pre_install='exit 3'),
+                    DotFile('.inputrc', pre_install={'run': 'sleep 5', 'timeout': 0.1}),
+                ], hooks={'pre_install': 'echo global pre >> ../../log',
+                          'post_install': 'echo global post >> ../../log'}).to_yaml()
+            },
+            'home': {}
+        })
+        plan = pot.PotRepo('pot').install(home='home')
+        eq_([op.kind for op in plan], ['link', 'fail', 'fail'])
+        ok_(os.path.islink('home/.vimrc'))
+        ok_(not os.path.lexists('home/.zshrc') and not os.path.lexists('home/.inputrc'))
+        with open('log') as fd:
+            eq_(fd.read().splitlines(), ['global pre', 'pre .vimrc', 'post .vimrc', 'global post'])
+        # dotfiles with failed hooks are retried, installed ones don't trigger hooks anymore
+        os.remove('log')
+        config = Config.load('pot/config.yaml')
+        config.dotfiles = config.dotfiles[:1] + [DotFile('.zshrc'), DotFile('.inputrc')]
+        with open('pot/config.yaml', 'w') as fd:
+            config.to_yaml(fd)
+        plan = pot.PotRepo('pot').install(home='home')
+        eq_([op.kind for op in plan], ['skip', 'link', 'link'])
+        with open('log') as fd:
+            eq_(fd.read().splitlines(), ['global pre', 'global post'])
+        os.remove('log')
+        pot.PotRepo('pot').install(home='home')
+        ok_(not os.path.exists('log'))
+        # failed post_install hooks are reported once dotfiles are installed
+        with open('pot/config.yaml', 'w') as fd:
+            Config([DotFile('.zshrc', post_install='exit 1')]).to_yaml(fd)
+        os.remove('home/.zshrc')
+        try:
+            pot.PotRepo('pot').install(home='home')
+            ok_(False, 'failed hook is not reported')
+        except pot.HookError as e:
+            eq_([op.kind for op in e.plan], ['link'])
+        ok_(os.path.islink('home/.zshrc'))
+        os.remove('home/.zshrc')
+        with cd('pot'):
+            ok_(not pot.install_roots(['../home']))
+        # failed pre_install hooks are reported by exit status as well
+        with open('pot/config.yaml', 'w') as fd:
+            Config([DotFile('.zshrc', pre_install='exit 1')]).to_yaml(fd)
+        os.remove('home/.zshrc')
+        with cd('pot'), updated_env(HOME=os.path.abspath('home')):
+            eq_(pot.install(), False)
+        # as well as missing configuration
+        with cd('home'):
+            eq_(pot.install(), False)
+        ok_(not os.path.lexists('home/.zshrc'))
+        # hooks aren't run for targets that are left as they were
+        with open('pot/config.yaml', 'w') as fd:
+            Config([DotFile('.zshrc', 'rc', action='include', pre_install='echo pre >> ../../log'),
+                    DotFile('.inputrc', action='copy',
+                            post_install='echo post "$POT_HOME" "$POT_TARGET_HOME" >> ../../log')]).to_yaml(fd)
+        with open('home/rc', 'w') as fd:
+            fd.write(pot.inclusion_line(os.path.abspath('pot/dotfiles/.zshrc')) + '\n')
+        with updated_env(POT_HOME='/global'):
+            eq_([op.kind for op in pot.PotRepo('pot').install(home='home')], ['skip', 'sync'])
+        with open('log') as fd:
+            eq_(fd.read().splitlines(), ['post /global ' + os.path.abspath('home')])
+        os.remove('log')
+        eq_([op.kind for op in pot.PotRepo('pot').install(home='home', full=True)], ['skip', 'sync'])
+        ok_(not os.path.exists('log'))
+
+
+if __name__ == '__main__':
+    nose.core.runmodule()